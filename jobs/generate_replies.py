@@ -1,7 +1,16 @@
-from modal import App, Cron, Function
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from modal import App, Cls, Cron, Function
+from pathlib import Path
 import logging
+import os
+import sys
+import threading
 import time
 
+# the record layout is shared with x_client, Modal mounts the module next to this job
+sys.path.append(str(Path(__file__).resolve().parents[1] / "src"))
+from tweet_record import TweetRecord  # noqa: E402
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -12,6 +21,55 @@ logger = logging.getLogger(__name__)
 
 app = App("generate_replies_job")
 
+# how long a list reads new pages, leaves time to answer the last page
+JOB_DEADLINE = 480
+# post the reply thread while the reply is generated instead of after it
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "true").lower() == "true"
+# seconds between writes of the list cursors, a list is always written when it is done
+CHECKPOINT_FLUSH_INTERVAL = 30
+
+
+class CursorCheckpointer:
+    """
+    Write-behind store of the latest_post_id of the lists.
+
+    Cursor updates are coalesced in data and written at most every flush
+    interval or on flush(). Cursors only move forward and the writes are
+    done one after the other under a lock shared by the list threads, so a
+    stored cursor never goes back.
+    """
+
+    def __init__(self, data, save_data, flush_interval=CHECKPOINT_FLUSH_INTERVAL):
+        self.data = data
+        self.save_data = save_data
+        self.flush_interval = flush_interval
+        self.dirty = False
+        self.flushed_at = time.monotonic()
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def advance(self, list_data, post_id):
+        with self.lock:
+            if post_id <= list_data['latest_post_id']:
+                return
+            list_data['latest_post_id'] = post_id
+            self.dirty = True
+            if time.monotonic() - self.flushed_at >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.dirty:
+            return
+        self.save_data.remote(self.data)
+        self.dirty = False
+        self.flushed_at = time.monotonic()
+        self.writes += 1
+
+
 @app.function(
     schedule=Cron("*/15 6-21 * * *"),
     timeout=600
@@ -19,61 +77,86 @@ app = App("generate_replies_job")
 def generate_replies():
     read_data = Function.lookup("datastore", "read_data")
     save_data = Function.lookup("datastore", "save_data")
-    accept_job_x_list = Function.lookup("x_client", "accept_job_x_list")
-    get_job_result_endpoint = Function.lookup("x_client", "get_job_result_endpoint")
-    topic_classification = Function.lookup("cohere", "topic_classification")
-    generate_reply = Function.lookup("reply_pipeline", "generate_reply")
+    stream_list_tweets = Cls.lookup("x_client", "XClient")().stream_list_tweets
+    topic_classification_batch = Function.lookup("cohere", "topic_classification_batch")
+    generate_replies_batch = Cls.lookup("reply_pipeline", "ReplyPipeline")().generate_replies_batch
     send_message = Function.lookup("slack", "send_message")
+    stream_reply_to_slack = Function.lookup("slack", "stream_reply_to_slack")
     data = read_data.remote()
     x_lists = data['users']['markusodenthal']['lists']
-    for list_name, list_data in x_lists.items():
-        logger.info(f"Processing list {list_name}")
+    checkpointer = CursorCheckpointer(data, save_data)
+
+    def process_list(list_name, list_data):
         slack_channel_id = list_data['slack_channel_id']
-        list_id = list_data['id']
-        latest_post_id = list_data['latest_post_id']
-    
-        call_id = accept_job_x_list.remote(list_id=list_id, latest_post_id=latest_post_id)
-        time.sleep(10)
-        results = get_job_result_endpoint.remote(call_id=call_id)
-        max_retries = 15
-        retry_count = 0
-        while results["status_code"] == 202:
-            print("Job not ready yet, waiting before retrying...")
-            time.sleep(60)
-            results = get_job_result_endpoint.remote(call_id=call_id)
-            retry_count += 1
-            if retry_count > max_retries:
-                logger.error("Max retries exceeded. Exiting loop.")
-                break
-            logger.info("Post processing completed. Ready to save data.")
-        logger.info("Job completed, results received:")
-        tweets, users = results["result"]
-        if len(tweets) == 0:
-            logger.info("No tweets found, skipping list.")
-            continue
-        logger.info(f"Number of tweets {str(len(tweets))}")
-
-        for tweet in tweets:
-            tweet_id = int(tweet.get("id"))
-            if tweet_id > latest_post_id:
-                latest_post_id = tweet_id
-                list_data['latest_post_id'] = latest_post_id
-                save_data.spawn(data)
-            tweet_text = tweet.get("text")
-            classification = topic_classification.remote(post=tweet_text)
-            if classification != "interesting_topic":
-                continue
+        started = time.monotonic()
+        newest_post_id = None
+        # pages arrive while later pages are still loading, each is classified and answered right away
+        for page in stream_list_tweets.remote_gen(list_id=list_data['id'], latest_post_id=list_data['latest_post_id']):
+            if isinstance(page, dict):
+                # the cursor stays where it is, the next run fetches the list again
+                retry_after = page.get("retry_after")
+                if retry_after is not None:
+                    logger.error(f"List {list_name} is rate limited for {retry_after:.0f}s, skipping list.")
+                else:
+                    logger.error(f"Fetching list {list_name} failed, skipping list: {page['error']}")
+                return
+            packed_tweets, users = page
+            tweets = [TweetRecord.unpack(values) for values in packed_tweets]
+            logger.info(f"Number of tweets {str(len(tweets))} in page of list {list_name}")
+
+            interesting = []
+            classifications = topic_classification_batch.remote([tweet.text for tweet in tweets])
+            for tweet, classification in zip(tweets, classifications):
+                if classification != "interesting_topic":
+                    continue
 
-            author_id = tweet["metadata"].get("author_id")
-            user = users.get(author_id)
-            if user:
-                user_name = user.get("username")
-                user_description = user.get("description")
-            else:
-                logger.info(f"No user information available for author_id {author_id}")
-                user_name = "No user information available"
-                user_description = "No user information available"
-            ideas, top_comments, final_reply = generate_reply.remote(tweet=tweet_text, user_name=user_name, user_description=user_description)
+                user = users.get(tweet.author_id)
+                if user:
+                    user_name = user.get("username")
+                    user_description = user.get("description")
+                else:
+                    logger.info(f"No user information available for author_id {tweet.author_id}")
+                    user_name = "No user information available"
+                    user_description = "No user information available"
+                interesting.append((tweet.id, tweet.text, tweet.author_id, user_name, user_description))
+            if interesting:
+                send_replies(list_name, slack_channel_id, interesting)
+            newest_post_id = max(newest_post_id or 0, *(tweet.id for tweet in tweets))
+
+            if time.monotonic() - started > JOB_DEADLINE:
+                logger.error(f"List {list_name} not done within {JOB_DEADLINE}s, skipping the rest of the list.")
+                return
+
+        if newest_post_id is None:
+            logger.info(f"No tweets found, skipping list {list_name}.")
+            return
+        # pages come newest first, so the cursor only moves past the list once the replies
+        # of every page are handed off, a failed or timed out run fetches the same tweets again
+        checkpointer.advance(list_data, newest_post_id)
+        checkpointer.flush()
+
+    def send_replies(list_name, slack_channel_id, interesting):
+        if STREAM_REPLIES:
+            for result in stream_reply_to_slack.starmap(
+                [
+                    (slack_channel_id, author_id, tweet_id, tweet_text, user_name, user_description)
+                    for tweet_id, tweet_text, author_id, user_name, user_description in interesting
+                ],
+                order_outputs=False,
+                return_exceptions=True,
+            ):
+                if isinstance(result, Exception):
+                    logger.error(f"Streaming a reply in list {list_name} failed: {result}")
+            return
+        # replies come back in completion order, index points into interesting
+        for index, reply in generate_replies_batch.remote_gen(
+            [(tweet_text, user_name, user_description) for _, tweet_text, _, user_name, user_description in interesting]
+        ):
+            tweet_id, _, author_id, _, _ = interesting[index]
+            if isinstance(reply, dict):
+                logger.error(f"Reply for post {tweet_id} failed: {reply['error']}")
+                continue
+            ideas, top_comments, final_reply = reply
             send_message.spawn(
                 channel_id=slack_channel_id,
                 author_id=author_id,
@@ -81,7 +164,22 @@ def generate_replies():
                 ideas=ideas,
                 top_comments=top_comments,
                 final_reply=final_reply
-            )  
+            )
+
+    # every list is fetched, classified and answered in its own thread
+    with ThreadPoolExecutor(max_workers=max(len(x_lists), 1)) as executor:
+        futures = {
+            executor.submit(process_list, list_name, list_data): list_name
+            for list_name, list_data in x_lists.items()
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                # the cursor of a failed list stays where it is, the other lists go on
+                logger.exception(f"Processing list {futures[future]} failed: {e}")
+    checkpointer.flush()
+    logger.info(f"Saved list cursors {checkpointer.writes} times")
     return None
 
 @app.local_entrypoint()
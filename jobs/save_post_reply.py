@@ -1,7 +1,7 @@
 import logging
 import time
 
-from modal import App, Cron, Function
+from modal import App, Cls, Cron, Function
 
 # Set up logging
 logging.basicConfig(
@@ -13,6 +13,9 @@ logger = logging.getLogger(__name__)
 
 app = App("save_posts_replies_job")
 
+# how long to read the pages of one user before the user is skipped
+JOB_DEADLINE = 3600
+
 
 @app.function(schedule=Cron("0 2 * * *"), timeout=7200,)
 def save_post_reply():
@@ -20,10 +23,7 @@ def save_post_reply():
         read_data = Function.lookup("datastore", "read_data")
         save_data = Function.lookup("datastore", "save_data")
         f_upsert = Function.lookup("pinecone", "upsert")
-        f_accept_job = Function.lookup("x_client", "accept_job")
-        f_get_job_result_endpoint = Function.lookup(
-            "x_client", "get_job_result_endpoint"
-        )
+        stream_post_replies = Cls.lookup("x_client", "XClient")().stream_post_replies_from_user
         f_embed = Function.lookup("openai_client", "embed")
     except Exception as e:
         logger.exception(f"Function lookup failed: {str(e)}")
@@ -34,56 +34,61 @@ def save_post_reply():
     for username, user_data in data.get("users", {}).items():
         latest_post_id = user_data.get("latest_post_id", 0)
         logger.info(f"Latest post ID for {username}: {latest_post_id}")
+        # a new account has no cursor yet, its full history is fetched in parallel
+        backfill = not latest_post_id
 
         if latest_post_id is not None:
             latest_post_id += 1
         else:
             latest_post_id = 0
-        call_id = f_accept_job.remote(latest_post_id=latest_post_id, username=username)
-        results = f_get_job_result_endpoint.remote(call_id=call_id)
-        max_retries = 5
-        retry_count = 0
-        while results["status_code"] == 202:
-            print("Job not ready yet, waiting before retrying...")
-            time.sleep(30)
-            results = f_get_job_result_endpoint.remote(call_id=call_id)
-            retry_count += 1
-            if retry_count > max_retries:
-                logger.error("Max retries exceeded. Exiting loop.")
+        started = time.monotonic()
+        new_latest_post_id = None
+        # pages are embedded and upserted as they arrive, the cursor only moves once all of them are
+        for results in stream_post_replies.remote_gen(
+            latest_post_id=latest_post_id, username=username, backfill=backfill
+        ):
+            if "error" in results:
+                # the cursor of the user stays where it is, the next run tries again
+                retry_after = results.get("retry_after")
+                if retry_after is not None:
+                    logger.error(f"X rate limit reached for {username}, retry after {retry_after:.0f}s, skipping user.")
+                else:
+                    logger.error(f"Fetching posts of {username} failed, skipping user: {results['error']}")
                 break
-            # Placeholder for future implementation
-            logger.info("Post processing completed. Ready to save data.")
 
-        logger.info("Job completed, results received:")
-        results = results["result"]
+            # process tweets
+            tweets = results["tweets"]
+            if tweets:
+                doc_embeds = [f_embed.remote(d["text"])[0] for d in tweets]
+                vectors = []
+                for d, e in zip(tweets, doc_embeds):
+                    vectors.append({"id": d["id"], "values": e, "metadata": d["metadata"]})
+                f_upsert.remote(index_name="x-posts-markus-odenthal", vectors=vectors)
+                logger.info(f"{len(vectors)} posts upserted successfully!")
+            else:
+                logger.info("No new posts to process.")
 
-        # process tweets
-        tweets = results["tweets"]
-        if tweets:
-            doc_embeds = [f_embed.remote(d["text"])[0] for d in tweets]
-            vectors = []
-            for d, e in zip(tweets, doc_embeds):
-                vectors.append({"id": d["id"], "values": e, "metadata": d["metadata"]})
-            f_upsert.remote(index_name="x-posts-markus-odenthal", vectors=vectors)
-            logger.info(f"{len(vectors)} posts upserted successfully!")
-        else:
-            logger.info("No new posts to process.")
+            # proess replies
+            replies = results["replies"]
+            if replies:
+                doc_embeds = [f_embed.remote(d["text"])[0] for d in replies]
+                vectors = []
+                for d, e in zip(replies, doc_embeds):
+                    vectors.append({"id": d["id"], "values": e, "metadata": d["metadata"]})
+                f_upsert.remote(index_name="x-comments-markus-odenthal", vectors=vectors)
+                logger.info(f"{len(vectors)} comments upserted successfully!")
+            else:
+                logger.info("No new replies to process.")
 
-        # proess replies
-        replies = results["replies"]
-        if replies:
-            doc_embeds = [f_embed.remote(d["text"])[0] for d in replies]
-            vectors = []
-            for d, e in zip(replies, doc_embeds):
-                vectors.append({"id": d["id"], "values": e, "metadata": d["metadata"]})
-            f_upsert.remote(index_name="x-comments-markus-odenthal", vectors=vectors)
-            logger.info(f"{len(vectors)} comments upserted successfully!")
+            if results["latest_post_id"]:
+                new_latest_post_id = max(new_latest_post_id or 0, results["latest_post_id"])
+            if time.monotonic() - started > JOB_DEADLINE:
+                logger.error(f"Posts of {username} not done within {JOB_DEADLINE}s, skipping user.")
+                break
         else:
-            logger.info("No new replies to process.")
-
-        latest_post_id = results["latest_post_id"]
-        logger.info(f"Last post ID: {results['latest_post_id']}")
-        user_data["latest_post_id"] = latest_post_id
+            if new_latest_post_id is not None:
+                logger.info(f"Last post ID: {new_latest_post_id}")
+                user_data["latest_post_id"] = new_latest_post_id
 
     save_data.remote(data)
     logger.info("Data saved successfully")
@@ -0,0 +1,74 @@
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "src"))
+
+from x_client import process_tweets_columnar, process_tweets_rows  # noqa: E402
+
+AUTHOR_ID = 1234
+
+
+def make_tweets(n: int, thread_share: float = 0.3, seed: int = 0) -> list[dict]:
+    """Create tweets shaped like the get_user_posts output, some of them threads."""
+    rng = random.Random(seed)
+    tweets = []
+    tweet_id = 1_800_000_000_000_000_000
+    while len(tweets) < n:
+        thread_length = rng.randint(2, 6) if rng.random() < thread_share else 1
+        conversation_id = tweet_id
+        for position in range(min(thread_length, n - len(tweets))):
+            referenced_tweets = (
+                [{"type": "replied_to", "id": tweet_id - 1}] if position else None
+            )
+            tweets.append(
+                {
+                    "id": tweet_id,
+                    "text": f"Tweet {tweet_id}",
+                    "created_at": "2024-08-01T12:00:00+00:00",
+                    "conversation_id": conversation_id,
+                    "author_id": AUTHOR_ID,
+                    "in_reply_to_user_id": AUTHOR_ID if position else None,
+                    "referenced_tweets": referenced_tweets,
+                    "public_metrics": {
+                        "retweet_count": rng.randint(0, 50),
+                        "reply_count": rng.randint(0, 50),
+                        "like_count": rng.randint(0, 500),
+                        "quote_count": rng.randint(0, 10),
+                        "impression_count": rng.randint(0, 10_000),
+                    },
+                    "non_public_metrics": {
+                        "impression_count": rng.randint(0, 10_000),
+                        "engagements": rng.randint(0, 1_000),
+                        "user_profile_clicks": rng.randint(0, 100),
+                    },
+                    "data": {},
+                }
+            )
+            tweet_id += rng.randint(1, 1_000)
+    rng.shuffle(tweets)
+    return tweets
+
+
+def best_of(fn, tweets, repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(tweets, 0)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    print(f"{'tweets':>8} {'rows (s)':>10} {'columnar (s)':>13} {'speedup':>8}")
+    for n in (1_000, 10_000, 100_000):
+        tweets = make_tweets(n)
+        assert process_tweets_columnar(tweets, 0) == process_tweets_rows(tweets, 0)
+        rows = best_of(process_tweets_rows, tweets)
+        columnar = best_of(process_tweets_columnar, tweets)
+        print(f"{n:>8} {rows:>10.4f} {columnar:>13.4f} {rows / columnar:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
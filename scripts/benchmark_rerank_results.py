@@ -0,0 +1,46 @@
+import copy
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "src"))
+
+from replies_pipeline import rerank_results, rerank_results_vectorized  # noqa: E402
+
+
+def make_matches(n: int, seed: int = 0) -> list[dict]:
+    """Create matches shaped like the PineconeClient.query_index output."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "id": str(idx),
+            "score": rng.random(),
+            "metadata": {
+                "reply_engagements": rng.randint(0, 500),
+                "reply_created_at": (now - timedelta(days=rng.randint(0, 720), seconds=rng.randint(0, 86399))).isoformat(),
+            },
+        }
+        for idx in range(n)
+    ]
+
+
+def main():
+    top_k = 5
+    print(f"{'matches':>8} {'loop (ms)':>10} {'numpy (ms)':>11} {'speedup':>8}")
+    for n in (30, 60, 100, 1_000, 10_000):
+        matches = make_matches(n)
+        expected = [m["id"] for m in rerank_results(copy.deepcopy(matches), 0.3, 0.7)[:top_k]]
+        actual = [m["id"] for m in rerank_results_vectorized(copy.deepcopy(matches), 0.3, 0.7, top_k=top_k)]
+        assert expected == actual, (expected, actual)
+
+        number = max(1, 20_000 // n)
+        loop = min(timeit.repeat(lambda: rerank_results(matches, 0.3, 0.7)[:top_k], number=number, repeat=3)) / number
+        vectorized = min(timeit.repeat(lambda: rerank_results_vectorized(matches, 0.3, 0.7, top_k=top_k), number=number, repeat=3)) / number
+        print(f"{n:>8} {loop * 1000:>10.3f} {vectorized * 1000:>11.3f} {loop / vectorized:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
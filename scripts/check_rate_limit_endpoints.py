@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "src"))
+
+from x_client import RATE_LIMITED_ENDPOINTS, RateLimitScheduler  # noqa: E402
+
+# routes as tweepy.Client passes them to request()
+TWEEPY_ROUTES = {
+    "get_users_tweets": ("GET", "/2/users/123/tweets"),
+    "get_list_tweets": ("GET", "/2/lists/1823768325551480969/tweets"),
+    "get_tweets": ("GET", "/2/tweets"),
+}
+
+
+def main():
+    for method, (http_method, route) in TWEEPY_ROUTES.items():
+        endpoint = RateLimitScheduler.endpoint(http_method, route)
+        assert endpoint == RATE_LIMITED_ENDPOINTS[method], (method, endpoint)
+        print(f"{method:>17} {endpoint}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import logging
 import os
 from modal import App, Image, Secret
 import time
+from typing import List
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,42 +21,58 @@ with image.imports():
 
 app = App("cohere", image=image, secrets=[Secret.from_name("SocialMediaManager")])
 
+# most inputs the Cohere classify endpoint accepts per request
+CLASSIFY_BATCH_SIZE = 96
+
 
 @app.function()
 def topic_classification(post: str) -> str:
+    return topic_classification_batch.local([post])[0]
+
+
+@app.function()
+def topic_classification_batch(posts: List[str]) -> List[str]:
+    """
+    Classify many posts with one classify request per CLASSIFY_BATCH_SIZE posts.
+
+    Every post still gets its own LangSmith run and confidence feedback, the
+    tracers are flushed once at the end. Predictions are in the order of posts.
+    """
     api_key = os.getenv("COHERE_API_KEY")
     model_id = os.getenv("COHERE_MODEL_ID")
     if not api_key or not model_id:
         raise EnvironmentError("COHERE_API_KEY and COHERE_MODEL_ID must be set")
-    logger.info("Starting topic classification")
+    if not posts:
+        return []
+    logger.info(f"Starting topic classification of {len(posts)} posts")
     ls_client = Client()
     co = cohere.Client(api_key)
-    model_id = os.getenv("COHERE_MODEL_ID")
 
-    run_id = uuid4()
-    pipeline = RunTree(
-       name="topic_classification",
-       run_type="chain",
-       inputs={"post": post},
-       id=run_id,
-    )
-    response = co.classify(
-        model=model_id, inputs=[post]
-    )
-    prediction = response.classifications[0].prediction
-    confidence = response.classifications[0].confidence
+    predictions = []
+    for start in range(0, len(posts), CLASSIFY_BATCH_SIZE):
+        batch = posts[start:start + CLASSIFY_BATCH_SIZE]
+        response = co.classify(model=model_id, inputs=batch)
+        for post, classification in zip(batch, response.classifications):
+            run_id = uuid4()
+            pipeline = RunTree(
+                name="topic_classification",
+                run_type="chain",
+                inputs={"post": post},
+                id=run_id,
+            )
+            pipeline.end(outputs={"output": classification.prediction})
+            pipeline.post()
+            ls_client.create_feedback(
+                run_id,
+                key="confidence",
+                score=classification.confidence,
+            )
+            predictions.append(classification.prediction)
 
-    pipeline.end(outputs={"output": prediction})
-    pipeline.post()
-    ls_client.create_feedback(
-        run_id,
-        key="confidence",
-        score=confidence,
-    )
     logger.info("Topic classification completed")
     time.sleep(5)
     wait_for_all_tracers()
-    return prediction
+    return predictions
 
 @app.local_entrypoint()
 def test_function():
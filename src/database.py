@@ -1,12 +1,15 @@
 import os
+from typing import Optional
 
 import modal
 
-image = modal.Image.debian_slim(python_version="3.11").pip_install("pinecone-client")
+image = modal.Image.debian_slim(python_version="3.11").pip_install("pinecone-client", "numpy")
 with image.imports():
     import logging
     import os
 
+    import numpy as np
+
     from pinecone import Pinecone, ServerlessSpec
 
 app = modal.App(
@@ -51,7 +54,14 @@ class PineconeClient:
         pass
 
     @modal.method()
-    def query_index(self, index_name: str, query_vector, top_k=10):
+    def query_index(
+        self,
+        index_name: str,
+        query_vector,
+        top_k=10,
+        fields: Optional[list[str]] = None,
+        mmr_lambda: Optional[float] = None,
+    ):
         """
         Query the Pinecone index with a given query and return the results.
 
@@ -59,6 +69,11 @@ class PineconeClient:
             index_name (str): The name of the Pinecone index.
             query (str): The query to search for in the index.
             top_k (int, optional): The number of top results to return. Default is 10.
+            fields (list[str], optional): The metadata fields to return. Default is all
+                of them, an empty list skips the metadata in the Pinecone response too.
+            mmr_lambda (float, optional): Return the matches in maximal marginal relevance order
+                with this trade off between relevance (1) and diversity (0) instead of by score.
+                The vectors this needs stay in this container.
 
         Returns:
             dict: The query results.
@@ -68,20 +83,88 @@ class PineconeClient:
         results = index.query(
             vector=query_vector,
             top_k=top_k,
-            include_values=False,
-            include_metadata=True
+            include_values=mmr_lambda is not None,
+            include_metadata=fields != []
         )
+        ordered = results.matches
+        if mmr_lambda is not None and ordered:
+            order = mmr_order(query_vector, [match.values for match in ordered], mmr_lambda)
+            ordered = [ordered[i] for i in order]
         matches = [
-            {"id": match.id, "score": match.score, "metadata": match.metadata}
-            for match in results.matches
+            {"id": match.id, "score": match.score, "metadata": project(match.metadata, fields)}
+            for match in ordered
         ]
         return matches
 
+    @modal.method()
+    def fetch_metadata(self, index_name: str, ids: list[str], fields: Optional[list[str]] = None) -> dict:
+        """
+        Fetch the metadata of the given ids, to hydrate matches that were queried with few fields.
+
+        Returns:
+            dict: The metadata by id, ids that are not in the index are left out.
+        """
+        if not ids:
+            return {}
+        pc = self.pc
+        index = pc.Index(index_name)
+        results = index.fetch(ids=list(ids))
+        return {
+            vector_id: project(vector.metadata, fields)
+            for vector_id, vector in results.vectors.items()
+        }
+
+
+def mmr_order(query_embed, embeddings, lambda_mult: float) -> list[int]:
+    """
+    Indices of the embeddings in maximal marginal relevance order.
+
+    Each step picks the candidate most similar to the query, minus its
+    similarity to the closest already picked one, so near duplicates go last.
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embed, dtype=np.float32)
+    relevance = vectors @ (query / max(np.linalg.norm(query), 1e-12))
+    similarity = vectors @ vectors.T
+
+    order = []
+    redundancy = np.full(len(vectors), -np.inf)
+    remaining = np.ones(len(vectors), dtype=bool)
+    for _ in range(len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * (redundancy if order else 0.0)
+        scores[~remaining] = -np.inf
+        best = int(np.argmax(scores))
+        order.append(best)
+        remaining[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return order
+
+
+def project(metadata: Optional[dict], fields: Optional[list[str]]) -> dict:
+    """Keep only the given metadata fields, all of them when fields is None."""
+    metadata = metadata or {}
+    if fields is None:
+        return dict(metadata)
+    return {field: metadata[field] for field in fields if field in metadata}
+
 
 @app.function()
-def query(index_name: str, q_vector: list, top_k: int = 10) -> list[dict]:
+def query(
+    index_name: str,
+    q_vector: list,
+    top_k: int = 10,
+    fields: Optional[list[str]] = None,
+    mmr_lambda: Optional[float] = None,
+) -> list[dict]:
     """Query the Pinecone index with a given query and return the results."""
-    return PineconeClient().query_index.remote(index_name, q_vector, top_k)
+    return PineconeClient().query_index.remote(index_name, q_vector, top_k, fields, mmr_lambda)
+
+
+@app.function()
+def fetch_metadata(index_name: str, ids: list[str], fields: Optional[list[str]] = None) -> dict:
+    """Fetch the metadata of the given ids from a Pinecone index."""
+    return PineconeClient().fetch_metadata.remote(index_name, ids, fields)
 
 
 @app.function()
@@ -1,7 +1,8 @@
 import json
 import logging
 import pathlib
-from typing import Any, Dict
+import shutil
+from typing import Any, Dict, List, Optional
 
 from modal import App, Volume
 
@@ -16,6 +17,8 @@ app = App("datastore")
 
 instance = Volume.from_name("instance")
 VOL_MOUNT_PATH = pathlib.Path("/instance")
+CHECKPOINT_DIR = VOL_MOUNT_PATH / "checkpoints"
+METRICS_DIR = VOL_MOUNT_PATH / "metrics"
 
 
 @app.function(volumes={VOL_MOUNT_PATH: instance})
@@ -60,3 +63,85 @@ def read_data() -> Dict[str, Any]:
     except Exception as e:
         logger.exception(f"Unexpected error reading {store_path}: {str(e)}")
         return {}
+
+
+@app.function(volumes={VOL_MOUNT_PATH: instance})
+def save_checkpoint(key: str, page_index: int, page: Dict[str, Any]):
+    """
+    Store one page of a paginated crawl so a later run can resume after it.
+
+    Every page goes into its own file, so a crawl writes each page once.
+    """
+    store_path = CHECKPOINT_DIR / key / f"{page_index:06d}.json"
+    logger.info(f"Saving checkpoint {key} page {page_index} to {store_path}")
+
+    try:
+        store_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(store_path, "w") as file:
+            json.dump(page, file)
+        instance.commit()
+    except Exception as e:
+        logger.exception(f"Error while saving checkpoint {store_path}: {str(e)}")
+
+
+@app.function(volumes={VOL_MOUNT_PATH: instance})
+def read_checkpoint(key: str) -> Optional[List[Dict[str, Any]]]:
+    """The saved pages of a crawl in page order, or None if there is no checkpoint."""
+    store_dir = CHECKPOINT_DIR / key
+    instance.reload()
+
+    if not store_dir.is_dir():
+        return None
+    pages = []
+    for store_path in sorted(store_dir.glob("*.json")):
+        try:
+            with open(store_path, "r") as file:
+                pages.append(json.load(file))
+        except json.JSONDecodeError:
+            # a crawl can only resume after an unbroken run of pages
+            logger.error(f"Invalid JSON in checkpoint: {store_path}")
+            break
+    logger.info(f"Loaded {len(pages)} checkpoint pages of {key} from {store_dir}")
+    return pages or None
+
+
+@app.function(volumes={VOL_MOUNT_PATH: instance})
+def clear_checkpoint(key: str):
+    store_dir = CHECKPOINT_DIR / key
+    instance.reload()
+
+    if not store_dir.is_dir():
+        return
+    try:
+        shutil.rmtree(store_dir)
+        instance.commit()
+    except Exception as e:
+        logger.exception(f"Error while removing checkpoint {store_dir}: {str(e)}")
+
+
+@app.function(volumes={VOL_MOUNT_PATH: instance})
+def save_metrics(record: Dict[str, Any]):
+    """Store the metrics record of one reply run, one file per run so writers never collide."""
+    store_path = METRICS_DIR / f"{int(record['created_at'] * 1000):015d}-{record['run_id']}.json"
+
+    try:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        with open(store_path, "w") as file:
+            json.dump(record, file)
+        instance.commit()
+    except Exception as e:
+        logger.exception(f"Error while saving metrics {store_path}: {str(e)}")
+
+
+@app.function(volumes={VOL_MOUNT_PATH: instance})
+def read_metrics(limit: int) -> List[Dict[str, Any]]:
+    """The metrics records of the last runs, oldest first."""
+    instance.reload()
+    records = []
+    for store_path in sorted(METRICS_DIR.glob("*.json"))[-limit:]:
+        try:
+            with open(store_path, "r") as file:
+                records.append(json.load(file))
+        except json.JSONDecodeError:
+            logger.error(f"Invalid JSON in metrics: {store_path}")
+    return records
@@ -1,7 +1,15 @@
+import asyncio
+import hashlib
+import json
 import logging
 import math
 import os
+import threading
+import time
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+import modal
 from modal import App, Function, Image, Secret
 
 # Set up logging
@@ -12,222 +20,1207 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-image = Image.debian_slim(python_version="3.11").pip_install(
-    "langchain",
-    "langchain-anthropic",
-    "langchain-core",
-    "langchain-openai",
-    "langchainhub",
+PROMPT_NAMES = ["content_summary", "engagement_strategy", "reply_refinement"]
+# prompts shipped with the image, so a cold container needs no hub round trip
+PROMPT_SNAPSHOT_PATH = "/root/prompt_snapshot.json"
+PROMPT_REFRESH_TTL = int(os.getenv("PROMPT_REFRESH_TTL", 15 * 60))
+# near duplicate tweets within this cosine similarity share retrieval and summary
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", 12 * 60 * 60))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 256))
+# retrieval asks only for the matches and metadata fields a stage reads,
+# the example candidates are then packed into the prompts by the ContextPacker
+EXAMPLE_COMMENTS_TOP_K = 20
+EXAMPLE_POSTS_TOP_K = 20
+EXAMPLE_COMMENT_FIELDS = ["original_post", "reply"]
+EXAMPLE_POST_FIELDS = ["text"]
+SCORING_TOP_K = 30
+SCORING_FIELDS = ["reply_engagements", "reply_created_at"]
+# from this many matches the NumPy reranker beats the loop, see scripts/benchmark_rerank_results.py
+VECTORIZED_RERANK_MIN_RESULTS = 100
+# examples are picked by maximal marginal relevance until the token budget of the prompt part is used
+CONTEXT_ENCODING = "o200k_base"
+TIKTOKEN_CACHE_DIR = "/root/tiktoken_cache"
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.7))
+EXAMPLE_COMMENTS_TOKEN_BUDGET = int(os.getenv("EXAMPLE_COMMENTS_TOKEN_BUDGET", 2000))
+EXAMPLE_POSTS_TOKEN_BUDGET = int(os.getenv("EXAMPLE_POSTS_TOKEN_BUDGET", 1500))
+EXAMPLE_REPLIES_TOKEN_BUDGET = int(os.getenv("EXAMPLE_REPLIES_TOKEN_BUDGET", 800))
+# content summaries are memoized per topic cluster and retrieved example ids
+TOPIC_CLUSTER_BITS = 16
+SUMMARY_STORE_TTL = int(os.getenv("SUMMARY_STORE_TTL", 7 * 24 * 60 * 60))
+# USD per million prompt and completion tokens, matched by model name prefix
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (5.00, 15.00),
+    "claude-3-5-sonnet": (3.00, 15.00),
+}
+# runs aggregated by reply_metrics_report
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", 200))
+# hedged stages fire the backup model once the primary is slower than this percentile of its recent latencies
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", 100))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+# deadline until enough latencies are seen, and the lowest deadline ever used
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 20.0))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 5.0))
+# replies generated at once by generate_replies_batch, and inputs of the single ReplyPipeline container
+REPLY_BATCH_CONCURRENCY = int(os.getenv("REPLY_BATCH_CONCURRENCY", 8))
+# limits of the LLM providers, ReplyPipeline runs in one container so they hold for the whole app
+PROVIDER_LIMITS = {
+    "openai": (
+        int(os.getenv("OPENAI_MAX_CONCURRENCY", 8)),
+        int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 500)),
+    ),
+    "anthropic": (
+        int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", 4)),
+        int(os.getenv("ANTHROPIC_REQUESTS_PER_MINUTE", 50)),
+    ),
+}
+
+
+def prompt_ref(name: str) -> str:
+    """Pin a prompt to a commit with e.g. PROMPT_COMMIT_CONTENT_SUMMARY=<hash>."""
+    commit = os.getenv(f"PROMPT_COMMIT_{name.upper()}")
+    return f"{name}:{commit}" if commit else name
+
+
+def cache_tokenizer():
+    """Download the tokenizer while the image is built, tiktoken fetches it on first use otherwise."""
+    import tiktoken
+
+    tiktoken.get_encoding(CONTEXT_ENCODING)
+
+
+def snapshot_prompts():
+    """Pull the pinned prompts while the image is built and store them in it."""
+    from langchain import hub
+    from langchain_core.load import dumps
+
+    snapshot = {name: dumps(hub.pull(prompt_ref(name))) for name in PROMPT_NAMES}
+    with open(PROMPT_SNAPSHOT_PATH, "w") as file:
+        json.dump(snapshot, file)
+
+
+image = (
+    Image.debian_slim(python_version="3.11")
+    .pip_install(
+        "langchain",
+        "langchain-anthropic",
+        "langchain-core",
+        "langchain-openai",
+        "langchainhub",
+        "numpy",
+        "tiktoken",
+    )
+    .env({"TIKTOKEN_CACHE_DIR": TIKTOKEN_CACHE_DIR})
+    .run_function(snapshot_prompts, secrets=[Secret.from_name("SocialMediaManager")])
+    .run_function(cache_tokenizer)
 )
 with image.imports():
+    import numpy as np
+    import tiktoken
     from langchain import hub
+    from langchain_core.callbacks import BaseCallbackHandler
+    from langchain_core.load import loads
     from langchain_anthropic import ChatAnthropic
-    from langchain_core.output_parsers import XMLOutputParser
+    from langchain_core.output_parsers import StrOutputParser, XMLOutputParser
     from langchain_openai import ChatOpenAI
     import uuid
 
+    class StageUsageHandler(BaseCallbackHandler):
+        """Reports the model, token usage and failed attempts of the LLM calls of one stage."""
+
+        run_inline = True
+
+        def __init__(self, metrics: "RunMetrics", stage: str):
+            self.metrics = metrics
+            self.stage = stage
+
+        def on_llm_end(self, response, **kwargs):
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    usage = getattr(message, "usage_metadata", None) or {}
+                    response_metadata = getattr(message, "response_metadata", None) or {}
+                    model = response_metadata.get("model_name") or response_metadata.get("model") or "unknown"
+                    self.metrics.add_llm_call(
+                        self.stage, model, usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+                    )
+
+        def on_llm_error(self, error, **kwargs):
+            # the losing call of a hedged stage is cancelled, that is not a failure
+            if not isinstance(error, asyncio.CancelledError):
+                self.metrics.add_llm_error(self.stage)
+
 app = App(
     "reply_pipeline", image=image, secrets=[Secret.from_name("SocialMediaManager")]
 )
+summary_store = modal.Dict.from_name("content_summaries", create_if_missing=True)
+semantic_cache_store = modal.Dict.from_name("semantic_cache", create_if_missing=True)
+hedge_store = modal.Dict.from_name("reply_hedger", create_if_missing=True)
 
 
-@app.function()
-def generate_reply(tweet: str, user_name: str, user_description: str):
+class PromptRegistry:
+    """
+    The hub prompts of the pipeline, loaded once per container.
 
-    def rerank_results(results, similarity_weight=0.7, engagement_weight=0.3, half_life_days=30):
-        current_time = datetime.now(timezone.utc)
-        max_engagement = max(r['metadata'].get('reply_engagements', 0) for r in results)
+    Prompts start from the snapshot in the image and are pulled again from the
+    hub in a background thread once they are older than the TTL, so a reply
+    never waits on the hub.
+    """
 
-        for result in results:
-            similarity_score = result['score']  # Assuming this is the similarity score from 0-1
-            engagement_count = result['metadata'].get('reply_engagements', 0)  # Assuming this field exists
-            timestamp = datetime.fromisoformat(result['metadata'].get('reply_created_at', '2024-01-01T00:00:00+00:00'))
+    def __init__(self, names, ttl: int = PROMPT_REFRESH_TTL):
+        self.names = names
+        self.ttl = ttl
+        self.prompts = {}
+        self.loaded_at = 0.0
+        self.refreshing = threading.Lock()
+        try:
+            with open(PROMPT_SNAPSHOT_PATH, "r") as file:
+                snapshot = json.load(file)
+            self.prompts = {name: loads(snapshot[name]) for name in names}
+            self.loaded_at = os.path.getmtime(PROMPT_SNAPSHOT_PATH)
+        except (FileNotFoundError, KeyError, json.JSONDecodeError):
+            logger.warning("No prompt snapshot found, pulling prompts from the hub")
+            self.refresh()
 
-            # Normalize engagement count (you may need to adjust this based on your data)
-            normalized_engagement = engagement_count / max_engagement if max_engagement > 0 else 0
+    def refresh(self):
+        prompts = {name: hub.pull(prompt_ref(name)) for name in self.names}
+        self.prompts = prompts
+        self.loaded_at = time.time()
+        logger.info(f"Refreshed prompts {', '.join(map(prompt_ref, self.names))}")
 
-            # Calculate time decay
-            age_days = (current_time - timestamp).days
-            time_decay = math.pow(0.5, age_days / half_life_days)
+    def refresh_in_background(self):
+        if not self.refreshing.acquire(blocking=False):
+            return
 
-            # Calculate combined score
-            combined_score = (
-                similarity_score * similarity_weight +
-                normalized_engagement * engagement_weight
-            ) * time_decay
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.exception(f"Prompt refresh failed: {str(e)}")
+            finally:
+                self.refreshing.release()
 
-            result['combined_score'] = combined_score
+        threading.Thread(target=run, daemon=True).start()
 
-        # Sort results by combined score in descending order
-        return sorted(results, key=lambda x: x['combined_score'], reverse=True)
+    def get(self, name: str):
+        if time.time() - self.loaded_at > self.ttl:
+            self.refresh_in_background()
+        return self.prompts[name]
 
-    OUR_AUDIENCE = """I help mid-career tech professionals (30-40 years old) leverage smart systems and automation to exponentially grow their X presence, attract high-value clients, and maintain work-life balance."""
-    CONTENT_STRATEGY = """I share data-driven insights on X growth hacks, automated engagement strategies, and system optimization techniques specifically for tech professionals building their personal brand on X."""
 
-    try:
-        query = Function.lookup("pinecone", "query")
-        embed = Function.lookup("openai_client", "embed")
-    except Exception as e:
-        logger.exception(f"Function lookup failed: {str(e)}")
-        return
+OUR_AUDIENCE = """I help mid-career tech professionals (30-40 years old) leverage smart systems and automation to exponentially grow their X presence, attract high-value clients, and maintain work-life balance."""
+CONTENT_STRATEGY = """I share data-driven insights on X growth hacks, automated engagement strategies, and system optimization techniques specifically for tech professionals building their personal brand on X."""
 
-    # load chains
-    xml_parser = XMLOutputParser()
 
-    config = {"metadata": {"conversation_id": str(uuid.uuid4())}}
+def rerank_results(results, similarity_weight=0.7, engagement_weight=0.3, half_life_days=30):
+    current_time = datetime.now(timezone.utc)
+    max_engagement = max(r['metadata'].get('reply_engagements', 0) for r in results)
 
-    gpt_4o_mini = ChatOpenAI(model="gpt-4o-mini", temperature=1.0)
+    for result in results:
+        similarity_score = result['score']  # Assuming this is the similarity score from 0-1
+        engagement_count = result['metadata'].get('reply_engagements', 0)  # Assuming this field exists
+        timestamp = datetime.fromisoformat(result['metadata'].get('reply_created_at', '2024-01-01T00:00:00+00:00'))
 
-    gpt4o = ChatOpenAI(model="gpt-4o", temperature=1.0)
-    sonnet_3_5_0 = ChatAnthropic(
-        model="claude-3-5-sonnet-20240620",
-        api_key=os.getenv("ANTHROPIC_API_KEY"),
-        temperature=0.0,
-    )
-    sonnet_3_5_0_with_fallback = sonnet_3_5_0.with_fallbacks([gpt4o])
+        # Normalize engagement count (you may need to adjust this based on your data)
+        normalized_engagement = engagement_count / max_engagement if max_engagement > 0 else 0
 
-    tweet_embed = embed.remote([tweet])[0]
-    example_comments = query.remote(
-        index_name="x-comments-markus-odenthal", q_vector=tweet_embed, top_k=100
-    )
-    example_comments_str = "\n".join(
-        [
-            f"Post: {idx + 1}\n{comment['metadata']['original_post']}\n{'-'*50}\nReply: {idx + 1}\n{comment['metadata']['reply']}\n{'='*50}"
-            for idx, comment in enumerate(example_comments[:10])
-        ]
-    )
+        # Calculate time decay
+        age_days = (current_time - timestamp).days
+        time_decay = math.pow(0.5, age_days / half_life_days)
 
-    example_posts = query.remote(
-        index_name="x-posts-markus-odenthal", q_vector=tweet_embed
-    )
-    example_posts_str = "\n".join(
-        [
-            f"Post: {idx + 1}\n{post['metadata']['text']}\n{'-'*50}"
-            for idx, post in enumerate(example_posts)
-        ]
-    )
+        # Calculate combined score
+        combined_score = (
+            similarity_score * similarity_weight +
+            normalized_engagement * engagement_weight
+        ) * time_decay
 
-    ##########################################################
-    # Summarize the retrieved post and comments
-    ##########################################################  
-    content_summary_prompt = hub.pull("content_summary")
-    content_summary_chain = (
-        content_summary_prompt | gpt_4o_mini | xml_parser
-    )
-    content_summary = content_summary_chain.invoke(
-        {   
-            "TOPIC": tweet,
-            "OUR_POSTS": example_posts_str,
-            "OUR_REPLIES": example_comments_str,
-        },
-        config=config
+        result['combined_score'] = combined_score
+
+    # Sort results by combined score in descending order
+    return sorted(results, key=lambda x: x['combined_score'], reverse=True)
+
+
+def rerank_scores(
+    similarity, engagement, timestamps, current_time,
+    similarity_weight=0.7, engagement_weight=0.3, half_life_days=30,
+):
+    """
+    Combined scores of rerank_results computed on arrays in one pass.
+
+    Parameters:
+        similarity (np.ndarray): Similarity scores from 0-1.
+        engagement (np.ndarray): Engagement counts.
+        timestamps (np.ndarray): Creation times as datetime64[s].
+        current_time (np.datetime64): Time the age of a result is measured from.
+
+    Returns:
+        np.ndarray: The combined score of every result.
+    """
+    max_engagement = engagement.max(initial=0)
+    normalized_engagement = engagement / max_engagement if max_engagement > 0 else np.zeros(len(engagement))
+    # whole days like timedelta.days in rerank_results
+    age_days = (current_time - timestamps) // np.timedelta64(1, "D")
+    time_decay = np.power(0.5, age_days / half_life_days)
+    return (similarity * similarity_weight + normalized_engagement * engagement_weight) * time_decay
+
+
+def rerank_results_vectorized(results, similarity_weight=0.7, engagement_weight=0.3, half_life_days=30, top_k=None):
+    """
+    Same scores as rerank_results, but computed with NumPy and only the top_k
+    results are selected and sorted, see scripts/benchmark_rerank_results.py.
+    """
+    similarity = np.fromiter((result['score'] for result in results), float, len(results))
+    engagement = np.fromiter(
+        (result['metadata'].get('reply_engagements', 0) for result in results), float, len(results)
     )
-    content_summary_str = content_summary["root"][1]["summary"]
-
-    ##########################################################
-    # Create the engagement strategy   
-    ##########################################################  
-    engagement_strategy_prompt = hub.pull("engagement_strategy")
-    engagement_strategy_chain = (
-        engagement_strategy_prompt | sonnet_3_5_0_with_fallback | xml_parser
+    # X timestamps are UTC, the offset is dropped for numpy
+    timestamps = np.array(
+        [result['metadata'].get('reply_created_at', '2024-01-01T00:00:00+00:00')[:19] for result in results],
+        dtype="datetime64[s]",
     )
-    engagement_strategy = engagement_strategy_chain.invoke(
-        {
-            "INFLUENCER_POST": tweet,
-            "INFLUENCER_BIO": f"Name: {user_name}\nBio: {user_description}",
-            "OUR_AUDIENCE": OUR_AUDIENCE,
-            "CONTENT_STRATEGY": CONTENT_STRATEGY,
-            "PAST_CONTENT_SUMMARY": content_summary_str,  
-        },
-        config=config
+    # numpy's now is UTC as well
+    current_time = np.datetime64("now", "s")
+    scores = rerank_scores(
+        similarity, engagement, timestamps, current_time,
+        similarity_weight, engagement_weight, half_life_days,
     )
-    final_reply = engagement_strategy["root"][1]["reply_ideas"]
 
-    def get_average_expert_confidence_score(comment: str):
-        comment_embed = embed.remote([comment])[0]
-        comments = query.remote(
-            index_name="x-only-comments-markus-odenthal", q_vector=comment_embed, top_k=30
+    if top_k is None or top_k >= len(results):
+        top = np.argsort(-scores, kind="stable")
+    else:
+        top = np.argpartition(-scores, top_k)[:top_k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+    reranked = []
+    for index in top.tolist():
+        results[index]['combined_score'] = float(scores[index])
+        reranked.append(results[index])
+    return reranked
+
+
+class SemanticCache:
+    """
+    Retrieval context and content summary of recently seen tweets.
+
+    A tweet whose embedding is within the cosine threshold of a cached one
+    reuses its context, so quote tweets and posts seen in several lists skip
+    retrieval and the summary. Entries expire after the TTL and the least
+    recently used entry is dropped when the cache is full.
+
+    Entries and hit counters live in a Modal Dict, so they outlive the container
+    between two job runs. A container loads the unexpired entries once and
+    searches them in memory, new entries are written through. The counters are
+    added up without a Dict lock, there is only one ReplyPipeline container.
+    """
+
+    STATS_KEY = "stats"
+
+    def __init__(
+        self,
+        store: "modal.Dict",
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl: int = SEMANTIC_CACHE_TTL,
+        max_entries: int = SEMANTIC_CACHE_SIZE,
+    ):
+        self.store = store
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # counted since the last flush_stats
+        self.hits = 0
+        self.misses = 0
+        self.stats_lock = asyncio.Lock()
+        self.load()
+
+    @staticmethod
+    def normalize(embedding) -> "np.ndarray":
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def load(self):
+        now = time.time()
+        entries = []
+        for key, entry in self.store.items():
+            if key == self.STATS_KEY:
+                continue
+            if now - entry["created_at"] > self.ttl:
+                self.store.pop(key)
+            else:
+                entries.append((key, entry))
+        entries.sort(key=lambda item: item[1]["created_at"])
+        for key, _ in entries[:-self.max_entries]:
+            self.store.pop(key)
+        for key, entry in entries[-self.max_entries:]:
+            self.entries[key] = (entry["created_at"], entry["embedding"], entry["value"])
+
+    def evict_expired(self):
+        now = time.time()
+        for key, (created_at, _, _) in list(self.entries.items()):
+            if now - created_at > self.ttl:
+                # the Dict entry is removed by the next load
+                del self.entries[key]
+
+    def get(self, embedding) -> Optional[Dict]:
+        self.evict_expired()
+        if self.entries:
+            keys = list(self.entries)
+            vectors = np.stack([self.entries[key][1] for key in keys])
+            similarities = vectors @ self.normalize(embedding)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                self.hits += 1
+                self.entries.move_to_end(keys[best])
+                return self.entries[keys[best]][2]
+        self.misses += 1
+        return None
+
+    async def put(self, embedding, value: Dict):
+        key = uuid.uuid4().hex
+        entry = {"created_at": time.time(), "embedding": self.normalize(embedding), "value": value}
+        self.entries[key] = (entry["created_at"], entry["embedding"], value)
+        await self.store.put.aio(key, entry)
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            await self.store.pop.aio(evicted)
+
+    async def flush_stats(self):
+        """Add the hits and misses since the last flush to the totals in the Dict."""
+        async with self.stats_lock:
+            if not self.hits and not self.misses:
+                return
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+            totals = await self.store.get.aio(self.STATS_KEY) or {"hits": 0, "misses": 0}
+            await self.store.put.aio(
+                self.STATS_KEY, {"hits": totals["hits"] + hits, "misses": totals["misses"] + misses}
+            )
+
+    async def stats(self) -> Dict[str, float]:
+        await self.flush_stats()
+        totals = await self.store.get.aio(self.STATS_KEY) or {"hits": 0, "misses": 0}
+        lookups = totals["hits"] + totals["misses"]
+        return {
+            "hits": totals["hits"],
+            "misses": totals["misses"],
+            "hit_rate": totals["hits"] / lookups if lookups else 0.0,
+            "size": len(self.entries),
+        }
+
+
+class ContextPacker:
+    """
+    Builds the example parts of a prompt within a token budget.
+
+    Candidates are taken in the given order, the retrieval returns them in MMR
+    order already. A candidate that does not fit anymore is skipped, so a
+    shorter one after it can still use the budget.
+    """
+
+    def __init__(self, encoding: str = CONTEXT_ENCODING):
+        self.tokenizer = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, disallowed_special=()))
+
+    def pack(self, candidates: List[Dict], render, budget: int, separator: str = "\n") -> str:
+        """Join render(position, candidate) of the picked candidates, position counts from 1."""
+        parts = []
+        used = 0
+        separator_tokens = self.count(separator)
+        for candidate in candidates:
+            part = render(len(parts) + 1, candidate)
+            tokens = self.count(part) + (separator_tokens if parts else 0)
+            if used + tokens > budget:
+                continue
+            parts.append(part)
+            used += tokens
+        return separator.join(parts)
+
+
+def content_summary_key(tweet_embed, example_comments, example_posts) -> str:
+    """
+    Hash of the topic cluster of the tweet and the ids of the retrieved examples.
+
+    The topic cluster is the side of fixed random hyperplanes the embedding
+    falls on, so neighbouring topics with the same examples share a summary.
+    """
+    planes = np.random.default_rng(0).standard_normal((TOPIC_CLUSTER_BITS, len(tweet_embed)))
+    cluster = "".join("1" if side else "0" for side in (planes @ np.asarray(tweet_embed)) > 0)
+    comment_ids = sorted(comment["id"] for comment in example_comments)
+    post_ids = sorted(post["id"] for post in example_posts)
+    payload = json.dumps([cluster, post_ids, comment_ids])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SummaryStore:
+    """
+    Content summaries memoized across containers in a Modal Dict.
+
+    Summaries older than the TTL count as missing and are removed when read,
+    Modal drops entries that are not touched for a long time on its own.
+    """
+
+    def __init__(self, store: "modal.Dict", ttl: int = SUMMARY_STORE_TTL):
+        self.store = store
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = await self.store.get.aio(key)
+        if entry is not None and time.time() - entry["created_at"] > self.ttl:
+            await self.store.pop.aio(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["summary"]
+
+    async def put(self, key: str, summary: str):
+        await self.store.put.aio(key, {"summary": summary, "created_at": time.time()})
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class ProviderLimiter:
+    """
+    Caps the calls in flight to one LLM provider and spaces out their starts.
+
+    Used as ``async with limiter:`` around a single request, so a burst of
+    replies queues up here instead of running into the provider rate limit.
+    """
+
+    def __init__(self, max_concurrency: int, requests_per_minute: int):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.interval = 60.0 / requests_per_minute
+        self.next_start = 0.0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        now = time.monotonic()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        if start > now:
+            try:
+                await asyncio.sleep(start - now)
+            except BaseException:
+                # __aexit__ does not run for a task cancelled in here, e.g. a hedged loser
+                self.semaphore.release()
+                raise
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+
+class Hedger:
+    """
+    Runs a primary LLM call and fires a backup call once the primary takes longer than usual.
+
+    The deadline is the HEDGE_PERCENTILE of the recent primary latencies of the
+    stage, counted from the moment the primary got its provider limiter slot, so
+    queueing behind our own limits never fires the backup. The first call that
+    returns a valid answer wins and the other one is cancelled, a failed primary
+    starts the backup right away.
+
+    The latency windows, fired backups and win/loss counts are kept in a Modal
+    Dict, so the deadline builds on the calls of earlier runs. A primary that is
+    cancelled for a winning backup is recorded as a censored sample with its
+    elapsed time, which is at least the deadline. Leaving slow primaries out
+    would pull the percentile down and fire the backup ever earlier.
+    """
+
+    def __init__(self, store: "modal.Dict"):
+        self.store = store
+        self.latencies = {
+            stage: deque(latencies, maxlen=HEDGE_WINDOW)
+            for stage, latencies in store.get("latencies", {}).items()
+        }
+        self.hedged = store.get("hedged", {})
+        self.stats = store.get("stats", {})
+        self.save_lock = asyncio.Lock()
+
+    def deadline(self, stage: str) -> float:
+        latencies = self.latencies.get(stage, ())
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, float(np.percentile(latencies, HEDGE_PERCENTILE)))
+
+    def count(self, model: str, outcome: str):
+        stats = self.stats.setdefault(model, {"wins": 0, "losses": 0, "errors": 0})
+        stats[outcome] += 1
+
+    def record(self, stage: str, latency: float):
+        self.latencies.setdefault(stage, deque(maxlen=HEDGE_WINDOW)).append(latency)
+
+    async def save(self):
+        # one ReplyPipeline container writes the whole state, the lock keeps the last write the newest
+        async with self.save_lock:
+            await self.store.update.aio(
+                latencies={stage: list(latencies) for stage, latencies in self.latencies.items()},
+                hedged=dict(self.hedged),
+                stats={model: dict(stats) for model, stats in self.stats.items()},
+            )
+
+    async def run(self, stage: str, primary, backup):
+        """
+        primary and backup are (model, call) pairs. call(started) returns a new
+        awaitable of the answer and calls started() once the request is sent.
+
+        Returns the winning model, the answer and whether the backup was fired.
+        """
+        primary_model, primary_call = primary
+        backup_model, backup_call = backup
+        primary_started = asyncio.Event()
+        tasks = {asyncio.ensure_future(primary_call(primary_started.set)): primary_model}
+        hedged = False
+        error = None
+        # the primary may also fail before it is sent
+        waiting = asyncio.ensure_future(primary_started.wait())
+        try:
+            await asyncio.wait([waiting, *tasks], return_when=asyncio.FIRST_COMPLETED)
+            waiting.cancel()
+            start = time.perf_counter()
+            deadline = self.deadline(stage)
+            done, _ = await asyncio.wait(tasks, timeout=deadline)
+            while True:
+                for task in done:
+                    model = tasks.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        self.count(model, "errors")
+                        logger.warning(f"{model} failed in {stage}: {str(error)}")
+                        continue
+                    if model == primary_model:
+                        self.record(stage, time.perf_counter() - start)
+                    self.count(model, "wins")
+                    for loser in tasks.values():
+                        self.count(loser, "losses")
+                        if loser == primary_model:
+                            # censored, the primary would have taken at least this long
+                            self.record(stage, max(time.perf_counter() - start, deadline))
+                    await self.save()
+                    return model, task.result(), hedged
+                if not hedged:
+                    hedged = True
+                    self.hedged[stage] = self.hedged.get(stage, 0) + 1
+                    tasks[asyncio.ensure_future(backup_call(lambda: None))] = backup_model
+                elif not tasks:
+                    await self.save()
+                    raise error
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiting.cancel()
+            for task in tasks:
+                task.cancel()
+
+
+class StageGraph:
+    """
+    Runs async stages as soon as all stages they depend on are done.
+
+    Every stage gets the results of its dependencies as arguments, in the order
+    they were listed. Timings of the last run are kept for the critical path.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.timings = {}
+        self.started_at = 0.0
+
+    def add(self, name: str, stage, dependencies: List[str] = ()):
+        self.stages[name] = (stage, list(dependencies))
+
+    async def run(self) -> Dict[str, object]:
+        tasks = {}
+
+        async def run_stage(name):
+            stage, dependencies = self.stages[name]
+            inputs = [await tasks[dependency] for dependency in dependencies]
+            start = time.perf_counter()
+            result = await stage(*inputs)
+            self.timings[name] = (start, time.perf_counter())
+            return result
+
+        self.timings = {}
+        self.started_at = time.perf_counter()
+        for name in self.stages:
+            tasks[name] = asyncio.ensure_future(run_stage(name))
+        results = await asyncio.gather(*tasks.values())
+        return dict(zip(tasks, results))
+
+    def critical_path(self) -> List[str]:
+        """The chain of stages that decided the run time, walked back from the last stage."""
+        name = max(self.timings, key=lambda stage: self.timings[stage][1])
+        path = [name]
+        while self.stages[name][1]:
+            name = max(self.stages[name][1], key=lambda stage: self.timings[stage][1])
+            path.append(name)
+        return path[::-1]
+
+    def report(self) -> str:
+        path = self.critical_path()
+        total = self.timings[path[-1]][1] - self.started_at
+        stages = " -> ".join(
+            f"{name} {self.timings[name][1] - self.timings[name][0]:.2f}s" for name in path
         )
-        comments_reranked = rerank_results(comments, similarity_weight=0.3, engagement_weight=0.7)
-        comments_reranked = comments_reranked[:5]
-        average_expert_confidence_score = sum([comment['combined_score'] for comment in comments_reranked]) / len(comments_reranked)
-        
-        # Get the top 3 performing comments
-        top_3_comments = [
+        return f"Critical path {total:.2f}s: {stages}"
+
+
+def partial_tag_text(text: str, tag: str) -> str:
+    """The text inside <tag> of a completion that may still be streaming in."""
+    start = text.find(f"<{tag}>")
+    if start == -1:
+        return ""
+    content = text[start + len(tag) + 2:]
+    end = content.find(f"</{tag}>")
+    if end != -1:
+        return content[:end].strip()
+    # hold back what could be the start of the closing tag
+    cut = content.rfind("<")
+    if cut != -1 and f"</{tag}>".startswith(content[cut:]):
+        content = content[:cut]
+    return content.strip()
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    # longest prefix first, so gpt-4o-mini is not priced as gpt-4o
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            prompt_price, completion_price = MODEL_PRICES[name]
+            return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+    return 0.0
+
+
+class RunMetrics:
+    """
+    Timing spans, token usage, fallbacks and cost of one reply.
+
+    The LLM calls of a stage report here through the callback handler of
+    ``config(...)``, the spans are taken from the StageGraph of the run.
+    """
+
+    def __init__(self):
+        self.run_id = str(uuid.uuid4())
+        self.created_at = time.time()
+        self.started_at = time.perf_counter()
+        self.spans = {}
+        self.llm_calls = []
+        self.llm_errors = {}
+        self.hedges = {}
+
+    def config(self, config: Dict, stage: str) -> Dict:
+        return {**config, "callbacks": [StageUsageHandler(self, stage)]}
+
+    def add_llm_call(self, stage: str, model: str, prompt_tokens: int, completion_tokens: int):
+        self.llm_calls.append(
             {
-                'text': comment['metadata']['reply'],
-                'score': comment['combined_score'],
-                'engagement_rate': comment['metadata'].get('reply_engagements', 0),
-                'original_post': comment['metadata']['original_post']
+                "stage": stage,
+                "model": model,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "cost_usd": estimate_cost(model, prompt_tokens, completion_tokens),
             }
-            for comment in comments_reranked[:3]
+        )
+
+    def add_llm_error(self, stage: str):
+        self.llm_errors[stage] = self.llm_errors.get(stage, 0) + 1
+
+    def add_hedge(self, stage: str, winner: str, hedged: bool, backup_won: bool):
+        self.hedges[stage] = {"winner": winner, "hedged": hedged, "backup_won": backup_won}
+
+    def add_span(self, name: str, start: float, end: float):
+        self.spans[name] = {"start": round(start - self.started_at, 3), "seconds": round(end - start, 3)}
+
+    def add_graph(self, graph: "StageGraph"):
+        for name, (start, end) in graph.timings.items():
+            self.add_span(name, start, end)
+
+    def record(self, **extra) -> Dict:
+        stages = {}
+        for call in self.llm_calls:
+            stage = stages.setdefault(
+                call["stage"], {"models": [], "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+            )
+            stage["models"].append(call["model"])
+            for field in ("prompt_tokens", "completion_tokens", "cost_usd"):
+                stage[field] += call[field]
+        # a stage with a failed call that still produced an answer ran on the fallback model
+        for name, stage in stages.items():
+            stage["fallback"] = self.llm_errors.get(name, 0) > 0 or self.hedges.get(name, {}).get("backup_won", False)
+        return {
+            "run_id": self.run_id,
+            "created_at": self.created_at,
+            "total_seconds": round(max((span["start"] + span["seconds"] for span in self.spans.values()), default=0.0), 3),
+            "spans": self.spans,
+            "llm": stages,
+            "prompt_tokens": sum(call["prompt_tokens"] for call in self.llm_calls),
+            "completion_tokens": sum(call["completion_tokens"] for call in self.llm_calls),
+            "cost_usd": round(sum(call["cost_usd"] for call in self.llm_calls), 6),
+            "fallback": any(stage["fallback"] for stage in stages.values()),
+            "llm_errors": self.llm_errors,
+            "hedges": self.hedges,
+            **extra,
+        }
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0}
+    p50, p95 = np.percentile(values, [50, 95])
+    return {"p50": round(float(p50), 4), "p95": round(float(p95), 4)}
+
+
+def summarize_metrics(records: List[Dict]) -> Dict:
+    """p50/p95 per stage and per run, token usage and fallback rate of the given metrics records."""
+    span_seconds = {}
+    fallbacks = {}
+    model_calls = {}
+    hedge_wins = {}
+    for record in records:
+        for hedge in record.get("hedges", {}).values():
+            hedge_wins[hedge["winner"]] = hedge_wins.get(hedge["winner"], 0) + 1
+        for name, span in record["spans"].items():
+            span_seconds.setdefault(name, []).append(span["seconds"])
+        for name, stage in record["llm"].items():
+            fallbacks.setdefault(name, []).append(stage["fallback"])
+            for model in stage["models"]:
+                model_calls[model] = model_calls.get(model, 0) + 1
+    return {
+        "runs": len(records),
+        "total_seconds": percentiles([record["total_seconds"] for record in records]),
+        "cost_usd": percentiles([record["cost_usd"] for record in records]),
+        "prompt_tokens": percentiles([record["prompt_tokens"] for record in records]),
+        "completion_tokens": percentiles([record["completion_tokens"] for record in records]),
+        "stages": {name: percentiles(seconds) for name, seconds in span_seconds.items()},
+        "fallback_rate": {name: round(sum(flags) / len(flags), 4) for name, flags in fallbacks.items()},
+        "model_calls": model_calls,
+        "hedge_wins": hedge_wins,
+    }
+
+
+def expert_confidence_score(comments):
+    """Average combined score of the 5 best matching past replies and the top 3 of them."""
+    if len(comments) >= VECTORIZED_RERANK_MIN_RESULTS:
+        comments_reranked = rerank_results_vectorized(comments, similarity_weight=0.3, engagement_weight=0.7, top_k=5)
+    else:
+        comments_reranked = rerank_results(comments, similarity_weight=0.3, engagement_weight=0.7)[:5]
+    average_expert_confidence_score = sum([comment['combined_score'] for comment in comments_reranked]) / len(comments_reranked)
+
+    # Get the top 3 performing comments, text and original_post are only there if the query returned them
+    top_3_comments = [
+        {
+            'id': comment['id'],
+            'text': comment['metadata'].get('reply'),
+            'score': comment['combined_score'],
+            'engagement_rate': comment['metadata'].get('reply_engagements', 0),
+            'original_post': comment['metadata'].get('original_post')
+        }
+        for comment in comments_reranked[:3]
+    ]
+
+    return round(average_expert_confidence_score, 2), top_3_comments
+
+
+# one container with concurrent inputs, so every reply shares the same ProviderLimiters
+@app.cls(allow_concurrent_inputs=REPLY_BATCH_CONCURRENCY, concurrency_limit=1)
+class ReplyPipeline:
+    @modal.enter()
+    def connect(self):
+        """Build the LLM clients, their HTTP pools and the function handles once per container."""
+        try:
+            self.query = Function.lookup("pinecone", "query")
+            self.fetch_metadata = Function.lookup("pinecone", "fetch_metadata")
+            self.embed = Function.lookup("openai_client", "embed")
+            self.save_metrics = Function.lookup("datastore", "save_metrics")
+        except Exception as e:
+            logger.exception(f"Function lookup failed: {str(e)}")
+            raise
+
+        self.prompts = PromptRegistry(PROMPT_NAMES)
+        self.semantic_cache = SemanticCache(semantic_cache_store)
+        self.summaries = SummaryStore(summary_store)
+        self.limits = {
+            provider: ProviderLimiter(max_concurrency, requests_per_minute)
+            for provider, (max_concurrency, requests_per_minute) in PROVIDER_LIMITS.items()
+        }
+        self.xml_parser = XMLOutputParser()
+        self.gpt_4o_mini = ChatOpenAI(model="gpt-4o-mini", temperature=1.0)
+        self.gpt4o = ChatOpenAI(model="gpt-4o", temperature=1.0)
+        self.sonnet_3_5_0 = ChatAnthropic(
+            model="claude-3-5-sonnet-20240620",
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            temperature=0.0,
+        )
+        self.sonnet_3_5_0_with_fallback = self.sonnet_3_5_0.with_fallbacks([self.gpt4o])
+        self.hedger = Hedger(hedge_store)
+        self.packer = ContextPacker()
+
+    def chain(self, prompt_name: str, llm):
+        # composed per call, the registry may have swapped in a refreshed prompt
+        return self.prompts.get(prompt_name) | llm | self.xml_parser
+
+    async def score_reply_ideas(self, reply_texts: List[str]) -> List[Tuple[float, List[Dict]]]:
+        """
+        Score all reply ideas against our past replies at once.
+
+        The ideas are embedded in one call and the index queries run in
+        parallel, so scoring takes about as long for ten ideas as for one.
+        """
+        async with self.limits["openai"]:
+            comment_embeds = await self.embed.remote.aio(reply_texts)
+        results = [
+            comments
+            async for comments in self.query.starmap.aio(
+                [
+                    ("x-only-comments-markus-odenthal", comment_embed, SCORING_TOP_K, SCORING_FIELDS)
+                    for comment_embed in comment_embeds
+                ]
+            )
         ]
-        
-        return round(average_expert_confidence_score, 2), top_3_comments
-    
-    # Add average expert confidence score and top 3 comments to each reply idea
-    for idea in final_reply:
-        reply_text = list(idea.values())[0]
-        confidence_score, top_comments = get_average_expert_confidence_score(reply_text)
-        idea['confidence_score'] = confidence_score
-        idea['top_comments'] = top_comments
-    
-    # Sort ideas by confidence score in descending order
-    final_reply.sort(key=lambda x: x['confidence_score'], reverse=True)
-    
-    # Create the final reply string with scores at the beginning of each idea
-    ideas_str = "\n---\n".join([f"{idea['confidence_score']}: {list(idea.values())[0]}" for idea in final_reply[:3]])
-
-    best_idea = final_reply[0]
-    best_idea_str = list(best_idea.values())[0]
-    top_comments = best_idea['top_comments']
-    top_comments_str = "\n".join([f"Post: {idx + 1}\n{comment['original_post']}\n{'-'*10}\nReply: {idx + 1}\n{comment['text']}\n{'-'*10}\n{int(comment['engagement_rate'])} engagements\n{'='*50}" for idx, comment in enumerate(top_comments)])
-    reply_refinement_prompt = hub.pull("reply_refinement")
-    reply_refinement_chain = (
-        reply_refinement_prompt | sonnet_3_5_0_with_fallback | xml_parser
-    )
-    reply_refinement = reply_refinement_chain.invoke(
-        {   
-            "ORIGINAL_POST": tweet,
-            "REPLY_DRAFT": ideas_str,
-            "EXAMPLE_REPLIES": top_comments_str,
-        },
-        config=config
-    )
-    final_reply_str = reply_refinement["root"][1]["refined_reply"]
-    ##########################################################
-    # Create the reply draft   
-    ##########################################################  
-    # example_comments_reranked = rerank_results(example_comments, similarity_weight=0.3, engagement_weight=0.7)
-    # example_comments_reranked_str = "\n".join(
-    #     [
-    #         f"Post: {idx + 1}\n{comment['metadata']['original_post']}\n{'-'*50}\nReply: {idx + 1}\n{comment['metadata']['reply']}\n{'='*50}"
-    #         for idx, comment in enumerate(example_comments_reranked[:5])
-    #     ]
-    # )
-    # reply_drafter_prompt = hub.pull("reply_drafter")
-    # reply_drafter_chain = (
-    #     reply_drafter_prompt | sonnet_3_5_0_with_fallback | xml_parser
-    # )
-    # reply_draft = reply_drafter_chain.invoke(
-    #     {   
-    #         "INFLUENCER_POST": tweet,
-    #         "REPLY_OUTLINE": engagement_idea,
-    #         "PAST_POST_REPLIES": example_comments_reranked_str,
-    #     },
-    #     config=config
-    # )
-    # final_reply = reply_draft["root"][1]["social_media_reply"]
-
-    # TODO: Search: With this reply we search now similar past replies, important is that they are similar
-    # TODO: AI: Then we use next AI to refine this reply with this new information
-    return ideas_str, top_comments_str, final_reply_str
+        return [expert_confidence_score(comments) for comments in results]
+
+    async def hydrate_comments(self, comments: List[Dict]) -> List[Dict]:
+        """Fill in the reply and original post of scored comments, in one fetch for all of them."""
+        metadata = await self.fetch_metadata.remote.aio(
+            "x-only-comments-markus-odenthal", [comment['id'] for comment in comments], EXAMPLE_COMMENT_FIELDS
+        )
+        for comment in comments:
+            comment_metadata = metadata.get(comment['id'], {})
+            comment['text'] = comment_metadata.get('reply', '')
+            comment['original_post'] = comment_metadata.get('original_post', '')
+        return comments
+
+    async def hedged_chain(self, prompt_name: str, inputs: Dict, tag: str, config: Dict, metrics: RunMetrics):
+        """
+        Run a prompt on Sonnet, hedged with gpt-4o, and return the text of its <tag>.
+
+        An answer without the tag counts as failed, so the other model can still win.
+        """
+
+        def call(llm, provider):
+            async def invoke(started):
+                async with self.limits[provider]:
+                    started()
+                    result = await self.chain(prompt_name, llm).ainvoke(
+                        inputs, config=metrics.config(config, prompt_name)
+                    )
+                return result["root"][1][tag]
+
+            return invoke
+
+        primary_model, backup_model = self.sonnet_3_5_0.model, self.gpt4o.model_name
+        winner, answer, hedged = await self.hedger.run(
+            prompt_name,
+            (primary_model, call(self.sonnet_3_5_0, "anthropic")),
+            (backup_model, call(self.gpt4o, "openai")),
+        )
+        metrics.add_hedge(prompt_name, winner, hedged, winner == backup_model)
+        return answer
+
+    @modal.method()
+    async def cache_stats(self) -> Dict[str, float]:
+        """Semantic cache hits and misses over all runs, the size of the cache of this container."""
+        return await self.semantic_cache.stats()
+
+    @modal.method()
+    def hedge_stats(self) -> Dict[str, Dict]:
+        """Wins, losses and errors per model and the fired backups per stage over all runs."""
+        return {
+            "models": self.hedger.stats,
+            "hedged": self.hedger.hedged,
+            "deadlines": {stage: self.hedger.deadline(stage) for stage in self.hedger.latencies},
+        }
+
+    def reply_graph(self, tweet: str, user_name: str, user_description: str, config, metrics: RunMetrics) -> StageGraph:
+        """The stages up to the scored reply ideas, shared by the plain and the streaming reply."""
+        graph = StageGraph()
+
+        async def embed_tweet():
+            async with self.limits["openai"]:
+                return (await self.embed.remote.aio([tweet]))[0]
+
+        async def semantic_cache(tweet_embed):
+            return self.semantic_cache.get(tweet_embed)
+
+        async def query_comments(tweet_embed, cached):
+            if cached:
+                return cached["example_comments"]
+            return await self.query.remote.aio(
+                index_name="x-comments-markus-odenthal",
+                q_vector=tweet_embed,
+                top_k=EXAMPLE_COMMENTS_TOP_K,
+                fields=EXAMPLE_COMMENT_FIELDS,
+                mmr_lambda=MMR_LAMBDA,
+            )
+
+        async def query_posts(tweet_embed, cached):
+            if cached:
+                return cached["example_posts"]
+            return await self.query.remote.aio(
+                index_name="x-posts-markus-odenthal",
+                q_vector=tweet_embed,
+                top_k=EXAMPLE_POSTS_TOP_K,
+                fields=EXAMPLE_POST_FIELDS,
+                mmr_lambda=MMR_LAMBDA,
+            )
+
+        ##########################################################
+        # Summarize the retrieved post and comments
+        ##########################################################
+        async def content_summary(tweet_embed, cached, example_comments, example_posts):
+            if cached:
+                return cached["content_summary"]
+            summary_key = content_summary_key(tweet_embed, example_comments, example_posts)
+            content_summary_str = await self.summaries.get(summary_key)
+            if content_summary_str is None:
+                content_summary_str = await summarize(example_comments, example_posts)
+                await self.summaries.put(summary_key, content_summary_str)
+            await self.semantic_cache.put(
+                tweet_embed,
+                {
+                    "example_comments": example_comments,
+                    "example_posts": example_posts,
+                    "content_summary": content_summary_str,
+                },
+            )
+            return content_summary_str
+
+        async def summarize(example_comments, example_posts):
+            example_comments_str = self.packer.pack(
+                example_comments,
+                lambda idx, comment: f"Post: {idx}\n{comment['metadata']['original_post']}\n{'-'*50}\nReply: {idx}\n{comment['metadata']['reply']}\n{'='*50}",
+                EXAMPLE_COMMENTS_TOKEN_BUDGET,
+            )
+            example_posts_str = self.packer.pack(
+                example_posts,
+                lambda idx, post: f"Post: {idx}\n{post['metadata']['text']}\n{'-'*50}",
+                EXAMPLE_POSTS_TOKEN_BUDGET,
+            )
+            content_summary_chain = self.chain("content_summary", self.gpt_4o_mini)
+            async with self.limits["openai"]:
+                content_summary = await content_summary_chain.ainvoke(
+                    {
+                        "TOPIC": tweet,
+                        "OUR_POSTS": example_posts_str,
+                        "OUR_REPLIES": example_comments_str,
+                    },
+                    config=metrics.config(config, "content_summary")
+                )
+            return content_summary["root"][1]["summary"]
+
+        ##########################################################
+        # Create the engagement strategy
+        ##########################################################
+        async def engagement_strategy(content_summary_str):
+            return await self.hedged_chain(
+                "engagement_strategy",
+                {
+                    "INFLUENCER_POST": tweet,
+                    "INFLUENCER_BIO": f"Name: {user_name}\nBio: {user_description}",
+                    "OUR_AUDIENCE": OUR_AUDIENCE,
+                    "CONTENT_STRATEGY": CONTENT_STRATEGY,
+                    "PAST_CONTENT_SUMMARY": content_summary_str,
+                },
+                "reply_ideas",
+                config,
+                metrics,
+            )
+
+        async def scoring(final_reply):
+            # Add average expert confidence score and top 3 comments to each reply idea
+            reply_texts = [list(idea.values())[0] for idea in final_reply]
+            for idea, (confidence_score, top_comments) in zip(final_reply, await self.score_reply_ideas(reply_texts)):
+                idea['confidence_score'] = confidence_score
+                idea['top_comments'] = top_comments
+
+            # Sort ideas by confidence score in descending order
+            final_reply.sort(key=lambda x: x['confidence_score'], reverse=True)
+
+            # Create the final reply string with scores at the beginning of each idea
+            ideas_str = "\n---\n".join([f"{idea['confidence_score']}: {list(idea.values())[0]}" for idea in final_reply[:3]])
+
+            best_idea = final_reply[0]
+            # only the comments of the best idea are shown, so only they get their texts
+            top_comments = await self.hydrate_comments(best_idea['top_comments'])
+            # already ranked by confidence, so they are packed in order within the budget
+            top_comments_str = self.packer.pack(
+                top_comments,
+                lambda idx, comment: f"Post: {idx}\n{comment['original_post']}\n{'-'*10}\nReply: {idx}\n{comment['text']}\n{'-'*10}\n{int(comment['engagement_rate'])} engagements\n{'='*50}",
+                EXAMPLE_REPLIES_TOKEN_BUDGET,
+            )
+            return ideas_str, top_comments_str
+
+        graph.add("embed", embed_tweet)
+        graph.add("semantic_cache", semantic_cache, ["embed"])
+        graph.add("query_comments", query_comments, ["embed", "semantic_cache"])
+        graph.add("query_posts", query_posts, ["embed", "semantic_cache"])
+        graph.add(
+            "content_summary",
+            content_summary,
+            ["embed", "semantic_cache", "query_comments", "query_posts"],
+        )
+        graph.add("engagement_strategy", engagement_strategy, ["content_summary"])
+        graph.add("scoring", scoring, ["engagement_strategy"])
+        return graph
+
+    async def log_run(self, graph: StageGraph, metrics: RunMetrics):
+        logger.info(graph.report())
+        logger.info(f"Semantic cache: {await self.semantic_cache.stats()}")
+        logger.info(f"Summary store: {self.summaries.stats()}")
+        record = metrics.record(critical_path=graph.critical_path())
+        logger.info(f"Reply metrics: {json.dumps(record)}")
+        await self.save_metrics.spawn.aio(record)
+
+    @modal.method()
+    async def generate_reply(self, tweet: str, user_name: str, user_description: str):
+        return await self.reply(tweet, user_name, user_description)
+
+    @modal.method()
+    async def generate_replies_batch(self, items: List[Tuple[str, str, str]]):
+        """
+        Generate replies for many (tweet, user_name, user_description) items at once.
+
+        At most REPLY_BATCH_CONCURRENCY replies run at the same time and the LLM
+        calls wait for their provider limits. Yields (index, result) in
+        completion order, result is the generate_reply tuple or {"error": ...}.
+        """
+        semaphore = asyncio.Semaphore(REPLY_BATCH_CONCURRENCY)
+
+        async def run(index, tweet, user_name, user_description):
+            async with semaphore:
+                try:
+                    return index, await self.reply(tweet, user_name, user_description)
+                except Exception as e:
+                    logger.exception(f"Reply {index} of the batch failed: {str(e)}")
+                    return index, {"error": str(e)}
+
+        tasks = [asyncio.ensure_future(run(index, *item)) for index, item in enumerate(items)]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+    async def reply(self, tweet: str, user_name: str, user_description: str):
+        metrics = RunMetrics()
+        config = {"metadata": {"conversation_id": metrics.run_id}}
+        graph = self.reply_graph(tweet, user_name, user_description, config, metrics)
+
+        async def reply_refinement(scored_ideas):
+            ideas_str, top_comments_str = scored_ideas
+            return await self.hedged_chain(
+                "reply_refinement",
+                {
+                    "ORIGINAL_POST": tweet,
+                    "REPLY_DRAFT": ideas_str,
+                    "EXAMPLE_REPLIES": top_comments_str,
+                },
+                "refined_reply",
+                config,
+                metrics,
+            )
+
+        graph.add("reply_refinement", reply_refinement, ["scoring"])
+        results = await graph.run()
+        metrics.add_graph(graph)
+        await self.log_run(graph, metrics)
+
+        ideas_str, top_comments_str = results["scoring"]
+        final_reply_str = results["reply_refinement"]
+        ##########################################################
+        # Create the reply draft
+        ##########################################################
+        # example_comments_reranked = rerank_results(example_comments, similarity_weight=0.3, engagement_weight=0.7)
+        # example_comments_reranked_str = "\n".join(
+        #     [
+        #         f"Post: {idx + 1}\n{comment['metadata']['original_post']}\n{'-'*50}\nReply: {idx + 1}\n{comment['metadata']['reply']}\n{'='*50}"
+        #         for idx, comment in enumerate(example_comments_reranked[:5])
+        #     ]
+        # )
+        # reply_drafter_prompt = hub.pull("reply_drafter")
+        # reply_drafter_chain = (
+        #     reply_drafter_prompt | sonnet_3_5_0_with_fallback | xml_parser
+        # )
+        # reply_draft = reply_drafter_chain.invoke(
+        #     {
+        #         "INFLUENCER_POST": tweet,
+        #         "REPLY_OUTLINE": engagement_idea,
+        #         "PAST_POST_REPLIES": example_comments_reranked_str,
+        #     },
+        #     config=config
+        # )
+        # final_reply = reply_draft["root"][1]["social_media_reply"]
+
+        # TODO: Search: With this reply we search now similar past replies, important is that they are similar
+        # TODO: AI: Then we use next AI to refine this reply with this new information
+        return ideas_str, top_comments_str, final_reply_str
+
+    @modal.method()
+    async def stream_reply(self, tweet: str, user_name: str, user_description: str):
+        """
+        Like generate_reply, but yields events as soon as they exist.
+
+        Yields ("ideas", (ideas_str, top_comments_str)) once the ideas are scored,
+        then ("refined_reply", partial_reply) while the refinement streams in and
+        ("final_reply", final_reply_str) at the end.
+        """
+        metrics = RunMetrics()
+        config = {"metadata": {"conversation_id": metrics.run_id}}
+        graph = self.reply_graph(tweet, user_name, user_description, config, metrics)
+        results = await graph.run()
+        metrics.add_graph(graph)
+
+        ideas_str, top_comments_str = results["scoring"]
+        yield "ideas", (ideas_str, top_comments_str)
+
+        reply_refinement_chain = (
+            self.prompts.get("reply_refinement")
+            | self.sonnet_3_5_0_with_fallback
+            | StrOutputParser()
+        )
+        completion = ""
+        refinement_start = time.perf_counter()
+        async with self.limits["anthropic"]:
+            async for chunk in reply_refinement_chain.astream(
+                {
+                    "ORIGINAL_POST": tweet,
+                    "REPLY_DRAFT": ideas_str,
+                    "EXAMPLE_REPLIES": top_comments_str,
+                },
+                config=metrics.config(config, "reply_refinement")
+            ):
+                completion += chunk
+                partial_reply = partial_tag_text(completion, "refined_reply")
+                if partial_reply:
+                    yield "refined_reply", partial_reply
+        metrics.add_span("reply_refinement", refinement_start, time.perf_counter())
+        await self.log_run(graph, metrics)
+        yield "final_reply", self.xml_parser.parse(completion)["root"][1]["refined_reply"]
+
+
+@app.function()
+def generate_reply(tweet: str, user_name: str, user_description: str):
+    """Kept for callers of the function, the work runs in the warm ReplyPipeline containers."""
+    return ReplyPipeline().generate_reply.remote(tweet, user_name, user_description)
+
+
+@app.function()
+def reply_metrics_report(last_n: int = METRICS_WINDOW) -> Dict:
+    """p50/p95 of the stage timings, tokens and cost over the last runs."""
+    read_metrics = Function.lookup("datastore", "read_metrics")
+    return summarize_metrics(read_metrics.remote(last_n))
+
+
+@app.local_entrypoint()
+def metrics_report(last_n: int = METRICS_WINDOW):
+    print(json.dumps(reply_metrics_report.remote(last_n), indent=2))
 
 
 @app.local_entrypoint()
 def test_function():
     logger.info("Starting test function")
-    generate_reply.local(
+    ReplyPipeline().generate_reply.remote(
         tweet="""The cost of ignorance is easy to quantify but hard to comprehend.
 The cost of not knowing how to get what you want is the value of the thing you want.
 And that education costs time and money.
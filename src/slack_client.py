@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 from typing import Any, Dict, List, Optional
 
 import modal
@@ -61,18 +62,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# seconds between chat_update calls while a reply streams in
+STREAM_UPDATE_INTERVAL = float(os.getenv("STREAM_UPDATE_INTERVAL", 1.0))
 
-@app.function()
-def send_message(
-    channel_id: str,
-    author_id: str,
-    post_id: str,
-    ideas: str,
-    top_comments: str,
-    final_reply: str
-):
-    slack_token = os.environ["SLACK_BOT_TOKEN"]
-    client = WebClient(token=slack_token)
+
+def post_new_post_message(client, channel_id: str, author_id: str, post_id: str) -> str:
+    """Post the parent message of a reply thread and return its ts."""
     response_post = client.chat_postMessage(
         channel=channel_id,
         text="New Post",
@@ -94,9 +89,13 @@ def send_message(
             },
         ],
     )
-    response_reply = client.chat_postMessage(
+    return response_post["ts"]
+
+
+def post_ideas(client, channel_id: str, thread_ts: str, ideas: str, top_comments: str):
+    client.chat_postMessage(
         channel=channel_id,
-        thread_ts=response_post["ts"],
+        thread_ts=thread_ts,
         text="💡 Ideas",
         blocks=[
             {
@@ -108,9 +107,9 @@ def send_message(
             },
         ],
     )
-    response_reply = client.chat_postMessage(
+    client.chat_postMessage(
         channel=channel_id,
-        thread_ts=response_post["ts"],
+        thread_ts=thread_ts,
         text="🔝 Top Comments",
         blocks=[
             {
@@ -122,14 +121,73 @@ def send_message(
             },
         ],
     )
-    response_reply = client.chat_postMessage(
+
+
+@app.function()
+def send_message(
+    channel_id: str,
+    author_id: str,
+    post_id: str,
+    ideas: str,
+    top_comments: str,
+    final_reply: str
+):
+    slack_token = os.environ["SLACK_BOT_TOKEN"]
+    client = WebClient(token=slack_token)
+    thread_ts = post_new_post_message(client, channel_id, author_id, post_id)
+    post_ideas(client, channel_id, thread_ts, ideas, top_comments)
+    client.chat_postMessage(
         channel=channel_id,
-        thread_ts=response_post["ts"],
+        thread_ts=thread_ts,
         text=final_reply,
     )
     return None
 
 
+@app.function(timeout=600)
+def stream_reply_to_slack(
+    channel_id: str,
+    author_id: str,
+    post_id: str,
+    tweet: str,
+    user_name: str,
+    user_description: str
+):
+    """
+    Post the reply thread while the reply is still being generated.
+
+    The parent message goes out right away, the ideas as soon as they are
+    scored and the refined reply is edited in place as it streams in.
+    """
+    slack_token = os.environ["SLACK_BOT_TOKEN"]
+    client = WebClient(token=slack_token)
+    pipeline = modal.Cls.lookup("reply_pipeline", "ReplyPipeline")()
+    thread_ts = post_new_post_message(client, channel_id, author_id, post_id)
+
+    reply_ts = None
+    updated_at = 0.0
+    for event, value in pipeline.stream_reply.remote_gen(tweet, user_name, user_description):
+        if event == "ideas":
+            ideas, top_comments = value
+            post_ideas(client, channel_id, thread_ts, ideas, top_comments)
+            continue
+        if reply_ts is None:
+            reply_ts = client.chat_postMessage(
+                channel=channel_id, thread_ts=thread_ts, text=value
+            )["ts"]
+            updated_at = time.monotonic()
+            continue
+        # chat.update is rate limited, so partial replies are sent at most every interval
+        if event == "refined_reply" and time.monotonic() - updated_at < STREAM_UPDATE_INTERVAL:
+            continue
+        try:
+            client.chat_update(channel=channel_id, ts=reply_ts, text=value)
+            updated_at = time.monotonic()
+        except SlackApiError as e:
+            logger.warning(f"Updating the streamed reply failed: {e}")
+    return None
+
+
 @app.function()
 def send_classification_to_slack(post, label):
     slack_token = os.environ["SLACK_BOT_TOKEN"]
@@ -0,0 +1,53 @@
+import datetime
+from typing import Dict, NamedTuple, Tuple
+
+
+class TweetRecord(NamedTuple):
+    """
+    The fields of a processed post the reply jobs use.
+
+    Records leave XClient as plain tuples from `pack`, in the field order below,
+    and the jobs read them with `unpack`. This module needs neither tweepy nor
+    Modal, so the jobs import it as well and the field order is defined once.
+    """
+
+    id: int
+    text: str
+    author_id: int
+    conversation_id: int
+    # epoch seconds
+    created_at: int
+    retweet_count: int = 0
+    reply_count: int = 0
+    like_count: int = 0
+    quote_count: int = 0
+    impression_count: int = 0
+    bookmark_count: int = 0
+
+    @classmethod
+    def from_processed(cls, tweet: Dict) -> "TweetRecord":
+        """Build a record from an entry returned by process_tweets."""
+        metadata = tweet["metadata"]
+        created_at = metadata["created_at"]
+        if isinstance(created_at, str):
+            created_at = datetime.datetime.fromisoformat(created_at)
+        return cls(
+            id=int(tweet["id"]),
+            text=tweet["text"],
+            author_id=int(metadata["author_id"]),
+            conversation_id=int(tweet["conversation_id"]),
+            created_at=int(created_at.timestamp()) if created_at else 0,
+            retweet_count=metadata.get("retweet_count", 0),
+            reply_count=metadata.get("reply_count", 0),
+            like_count=metadata.get("like_count", 0),
+            quote_count=metadata.get("quote_count", 0),
+            impression_count=metadata.get("impression_count", 0),
+            bookmark_count=metadata.get("bookmark_count", 0),
+        )
+
+    def pack(self) -> Tuple:
+        return tuple(self)
+
+    @classmethod
+    def unpack(cls, values: Tuple) -> "TweetRecord":
+        return cls._make(values)
@@ -1,201 +1,867 @@
 import datetime
+import json
 import logging
 import os
+import pathlib
+import re
+import sqlite3
+import time
+import uuid
 from collections import defaultdict
-from typing import Dict, List, Tuple
+from itertools import chain
+from operator import itemgetter
+from typing import Dict, Iterator, List, Tuple
 
 import modal
 from modal.functions import FunctionCall
 
-image = modal.Image.debian_slim(python_version="3.11").pip_install("tweepy")
+from tweet_record import TweetRecord
+
+image = modal.Image.debian_slim(python_version="3.11").pip_install("tweepy", "numpy")
 with image.imports():
     import tweepy
 
+    class RateLimitExceeded(tweepy.TweepyException):
+        """Raised instead of sleeping when an endpoint has no requests left."""
+
+        def __init__(self, endpoint: str, retry_after: float):
+            super().__init__(f"Rate limit of {endpoint} exhausted, retry after {retry_after:.0f}s")
+            self.endpoint = endpoint
+            self.retry_after = retry_after
+
+        def __reduce__(self):
+            # keeps the hint when the error is raised in another container
+            return RateLimitExceeded, (self.endpoint, self.retry_after)
+
+    class RateLimitedClient(tweepy.Client):
+        """tweepy.Client that asks the shared RateLimitScheduler before every request."""
+
+        def __init__(self, scheduler: "RateLimitScheduler", **kwargs):
+            super().__init__(**kwargs)
+            self.scheduler = scheduler
+
+        def request(self, method, route, params=None, json=None, user_auth=False):
+            endpoint = RateLimitScheduler.endpoint(method, route)
+            retry_after = self.scheduler.acquire(endpoint)
+            if retry_after > 0:
+                raise RateLimitExceeded(endpoint, retry_after)
+            try:
+                response = super().request(
+                    method, route, params=params, json=json, user_auth=user_auth
+                )
+            except tweepy.TooManyRequests as e:
+                self.scheduler.update(endpoint, e.response.headers)
+                retry_after = max(self.scheduler.retry_after(endpoint), 1.0)
+                self.scheduler.add_throttled(endpoint, retry_after)
+                raise RateLimitExceeded(endpoint, retry_after) from e
+            self.scheduler.update(endpoint, response.headers)
+            return response
+
 app = modal.App(
     "x_client", image=image, secrets=[modal.Secret.from_name("SocialMediaManager")]
 )
 
+cache_volume = modal.Volume.from_name("x_client_cache", create_if_missing=True)
+CACHE_MOUNT_PATH = pathlib.Path("/cache")
+rate_limits = modal.Dict.from_name("x_rate_limits", create_if_missing=True)
+cache_counters = modal.Dict.from_name("x_client_cache_counters", create_if_missing=True)
+
 
 logger = logging.getLogger(__name__)
 
+# get_tweets accepts at most 100 ids per request
+GET_TWEETS_MAX_IDS = 100
+# every tweet lookup requests the same fields so cached entries serve all callers
+TWEET_FIELDS = [
+    "created_at",
+    "public_metrics",
+    "conversation_id",
+    "in_reply_to_user_id",
+    "note_tweet",
+]
+TWEET_EXPANSIONS = ["referenced_tweets.id", "author_id"]
+USER_FIELDS = ["description", "created_at"]
+# public_metrics change over time, everything else of a tweet is immutable
+TWEET_METRICS_TTL = int(os.getenv("TWEET_METRICS_TTL", 6 * 60 * 60))
+USER_TTL = int(os.getenv("USER_TTL", 7 * 24 * 60 * 60))
+# number of time windows a full history backfill is fetched in parallel
+BACKFILL_SHARDS = int(os.getenv("BACKFILL_SHARDS", 8))
+# user timelines can not be queried before this date
+BACKFILL_START_TIME = datetime.datetime(2010, 11, 6)
+# the user timeline endpoint only returns this many of the most recent posts
+USER_TIMELINE_LIMIT = 3200
+# posts of the probe page that measures how fast a user posts
+BACKFILL_PROBE_SIZE = 100
+# from this many tweets process_tweets switches to the NumPy implementation
+COLUMNAR_MIN_TWEETS = 1000
+
+
+class TweetCache:
+    """
+    SQLite cache of raw tweet and user payloads keyed by id.
+
+    Tweets are stored once and never refetched, only their public_metrics are
+    refreshed after TWEET_METRICS_TTL seconds.
+
+    Every container works on its own copy of the database and the last one to
+    commit the volume wins, rows another container added meanwhile are fetched
+    again later. Hit and miss counters are therefore not kept in the database
+    but in a Modal Dict, one entry per container, and summed up by stats().
+    """
+
+    def __init__(self, path: str, metrics_ttl: int, user_ttl: int, counters_store: "modal.Dict"):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tweets (
+                id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                metrics_fetched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                username TEXT,
+                data TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS users_username ON users (username);
+            """
+        )
+        self.metrics_ttl = metrics_ttl
+        self.user_ttl = user_ttl
+        self.counters = defaultdict(int)
+        self.counters_store = counters_store
+        # the entry of this container holds its running totals, so writes never race
+        self.counters_key = str(uuid.uuid4())
+
+    def get_tweets(self, tweet_ids: List[int]) -> Tuple[Dict[int, Dict], List[int]]:
+        """Return the cached payloads and the ids whose public_metrics are stale."""
+        cached = {}
+        stale_ids = []
+        now = time.time()
+        for i in range(0, len(tweet_ids), 500):
+            ids_chunk = tweet_ids[i : i + 500]
+            rows = self.conn.execute(
+                f"SELECT id, data, metrics_fetched_at FROM tweets WHERE id IN ({','.join('?' * len(ids_chunk))})",
+                ids_chunk,
+            )
+            for tweet_id, data, metrics_fetched_at in rows:
+                cached[tweet_id] = json.loads(data)
+                if now - metrics_fetched_at > self.metrics_ttl:
+                    stale_ids.append(tweet_id)
+        self.counters["tweet_hits"] += len(cached)
+        self.counters["tweet_misses"] += len(set(tweet_ids) - cached.keys())
+        self.counters["metrics_refreshes"] += len(stale_ids)
+        return cached, stale_ids
+
+    def put_tweets(self, payloads: List[Dict]):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO tweets (id, data, metrics_fetched_at) VALUES (?, ?, ?)",
+            [(int(payload["id"]), json.dumps(payload), now) for payload in payloads],
+        )
+        self.conn.commit()
+
+    def get_user(self, username: str = None, user_id: int = None) -> Dict:
+        if username:
+            row = self.conn.execute(
+                "SELECT data, fetched_at FROM users WHERE username = ?", (username.lower(),)
+            ).fetchone()
+        else:
+            row = self.conn.execute(
+                "SELECT data, fetched_at FROM users WHERE id = ?", (int(user_id),)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.user_ttl:
+            self.counters["user_misses"] += 1
+            return None
+        self.counters["user_hits"] += 1
+        return json.loads(row[0])
+
+    def put_user(self, payload: Dict):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO users (id, username, data, fetched_at) VALUES (?, ?, ?, ?)",
+            # X usernames are case insensitive, the jobs pass them in lowercase
+            (int(payload["id"]), payload["username"].lower(), json.dumps(payload), time.time()),
+        )
+        self.conn.commit()
+
+    def flush_counters(self):
+        if self.counters:
+            self.counters_store[self.counters_key] = dict(self.counters)
+
+    def stats(self) -> Dict[str, int]:
+        """The counters summed over all containers, Modal drops entries untouched for 30 days."""
+        self.flush_counters()
+        totals = defaultdict(int)
+        for _, counters in self.counters_store.items():
+            for name, value in counters.items():
+                totals[name] += value
+        return dict(totals)
+
+    def close(self):
+        self.flush_counters()
+        self.conn.close()
+
+
+# id segments of a route, the leading /2 API version is kept
+ROUTE_ID_PATTERN = re.compile(r"(?<!^)/\d+(?=/|$)")
+# endpoints of the tweepy methods that are planned together
+RATE_LIMITED_ENDPOINTS = {
+    "get_users_tweets": "GET /2/users/:id/tweets",
+    "get_list_tweets": "GET /2/lists/:id/tweets",
+    "get_tweets": "GET /2/tweets",
+}
+
+
+class RateLimitScheduler:
+    """
+    Per endpoint token buckets filled from the x-rate-limit-* response headers.
+
+    The buckets live in a Modal Dict, so all XClient containers plan against the
+    same remaining budget. Callers get the seconds to wait instead of a sleep,
+    and the waiting time handed out is summed up per endpoint.
+
+    A request costs one Dict read before and one write after it. The bucket is
+    not decremented before the request: Modal Dicts have no atomic update, and
+    the headers of every response overwrite the bucket with the count X keeps.
+    Requests in flight in other containers can therefore overshoot by a few,
+    X answers those with a 429 that is raised as RateLimitExceeded as well.
+    """
+
+    def __init__(self, state: "modal.Dict"):
+        self.state = state
 
-@app.cls()
+    @staticmethod
+    def endpoint(method: str, route: str) -> str:
+        return f"{method} {ROUTE_ID_PATTERN.sub('/:id', route)}"
+
+    def retry_after(self, endpoint: str, requests: int = 1) -> float:
+        bucket = self.state.get(endpoint)
+        now = time.time()
+        if bucket is None or bucket["reset"] <= now or bucket["remaining"] >= requests:
+            return 0.0
+        return bucket["reset"] - now
+
+    def acquire(self, endpoint: str) -> float:
+        """Return 0 if the bucket has a request left, or the seconds until it refills."""
+        retry_after = self.retry_after(endpoint)
+        if retry_after > 0:
+            self.add_throttled(endpoint, retry_after)
+        return retry_after
+
+    def update(self, endpoint: str, headers) -> None:
+        if "x-rate-limit-remaining" not in headers:
+            return
+        self.state[endpoint] = {
+            "limit": int(headers.get("x-rate-limit-limit", 0)),
+            "remaining": int(headers["x-rate-limit-remaining"]),
+            "reset": int(headers["x-rate-limit-reset"]),
+        }
+
+    def add_throttled(self, endpoint: str, seconds: float) -> None:
+        key = f"throttled_seconds:{endpoint}"
+        self.state[key] = self.state.get(key, 0.0) + seconds
+
+    def plan(self, requests: Dict[str, int]) -> Dict[str, float]:
+        """
+        Return the seconds until each tweepy method can make its planned number of requests.
+
+        Parameters:
+            requests (Dict[str, int]): Number of requests per method name of RATE_LIMITED_ENDPOINTS.
+        """
+        return {
+            method: self.retry_after(RATE_LIMITED_ENDPOINTS[method], count)
+            for method, count in requests.items()
+        }
+
+    def status(self) -> Dict:
+        return dict(self.state.items())
+
+
+def error_response(e: Exception) -> Dict:
+    error = {"error": f"RequestException: {e}"}
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after is not None:
+        error["retry_after"] = retry_after
+    return error
+
+
+def tweet_to_dict(tweet) -> Dict:
+    """Convert a tweepy tweet of a thread into a plain dictionary."""
+    return {
+        "id": tweet.id,
+        "text": tweet.text,
+        "created_at": tweet.created_at.isoformat() if tweet.created_at else None,
+        "public_metrics": dict(tweet.public_metrics)
+        if tweet.public_metrics
+        else None,
+        "conversation_id": tweet.conversation_id,
+        "in_reply_to_user_id": tweet.in_reply_to_user_id,
+        "referenced_tweets": [dict(ref) for ref in tweet.referenced_tweets]
+        if tweet.referenced_tweets
+        else None,
+        "author_id": tweet.author_id,
+    }
+
+
+def process_tweets_rows(tweets, latest_post_id: int = None) -> Tuple[List[Dict], int]:
+    """Group tweets into posts and threads one tweet at a time, see XClient.process_tweets."""
+    # Group tweets by conversation_id
+    threads = defaultdict(list)
+    new_latest_post_id = latest_post_id
+
+    for tweet in tweets:
+        threads[tweet["conversation_id"]].append(tweet)
+
+    processed_tweets = []
+
+    for conversation_id, thread_tweets in threads.items():
+        sorted_tweets = sorted(
+            thread_tweets, key=lambda x: x["id"], reverse=True
+        )
+
+        # threads with more than one tweet
+        if len(sorted_tweets) > 1:
+            combined_text = "\n\n".join(
+                tweet["text"] for tweet in reversed(sorted_tweets)
+            )
+            combined_metrics = defaultdict(int)
+
+            for tweet in sorted_tweets:
+                for metric, value in tweet["public_metrics"].items():
+                    combined_metrics[metric] += value
+                if tweet["non_public_metrics"]:
+                    for metric, value in tweet["non_public_metrics"].items():
+                        combined_metrics[metric] += value
+
+            processed_tweet = {
+                "conversation_id": conversation_id,
+                "text": combined_text,
+                "created_at": sorted_tweets[0]["created_at"],
+                "metrics": dict(combined_metrics),
+                "tweet_ids": [str(tweet["id"]) for tweet in sorted_tweets],
+                "is_thread": True,
+                "author_id": sorted_tweets[0]["author_id"],
+            }
+            logger.info(f"Processed thread: {str(sorted_tweets[0]['id'])}")
+        # tweets and longform tweets
+        else:
+            tweet = sorted_tweets[0]
+            # exlude tweet where the author is replying to themselves
+            if (
+                tweet["referenced_tweets"]
+                and tweet["referenced_tweets"][0]["type"] == "replied_to"
+                and tweet["in_reply_to_user_id"] == tweet["author_id"]
+            ):
+                logger.info(f"Excluded tweet: {str(tweet['id'])}")
+                continue
+            all_metrics = {**tweet["public_metrics"]}
+            if tweet["non_public_metrics"]:
+                all_metrics.update(tweet["non_public_metrics"])
+
+            note_tweet = tweet["data"].get("note_tweet", None)
+            if note_tweet:
+                text = tweet["data"]["note_tweet"]["text"]
+                logger.info(f"Note tweet: {str(tweet['id'])}")
+            else:
+                text = tweet["text"]
+                logger.info(f"Processed tweet: {str(tweet['id'])}")
+            processed_tweet = {
+                "conversation_id": conversation_id,
+                "text": text,
+                "created_at": tweet["created_at"],
+                "metrics": all_metrics,
+                "tweet_ids": [str(tweet["id"])],
+                "is_thread": False,
+                "author_id": tweet["author_id"],
+            }
+
+        processed_tweets.append(processed_tweet)
+    processed_tweets.sort(key=lambda x: int(x["tweet_ids"][0]), reverse=True)
+
+    tweets_clean = []
+    for tweet in processed_tweets:
+        post_tweet_id = int(tweet["tweet_ids"][-1])
+        if new_latest_post_id is None or post_tweet_id > new_latest_post_id:
+            new_latest_post_id = post_tweet_id
+        metadata = {
+            "text": tweet["text"],
+            "created_at": tweet["created_at"],
+            "is_thread": tweet["is_thread"],
+            **tweet["metrics"],
+            "author_id": tweet["author_id"],
+        }
+        tweets_clean.append(
+            {
+                "id": tweet["tweet_ids"][0],
+                "text": tweet["text"],
+                "conversation_id": tweet["conversation_id"],
+                "metadata": metadata,
+            }
+        )
+
+    return tweets_clean, new_latest_post_id
+
+
+def process_tweets_columnar(
+    tweets, latest_post_id: int = None
+) -> Tuple[List[Dict], int]:
+    """
+    Same result as process_tweets_rows, but grouping, metric sums and ordering
+    run on NumPy arrays. Used for large backfills, see
+    scripts/benchmark_process_tweets.py for the comparison.
+    """
+    import numpy as np
+
+    if not tweets:
+        return [], latest_post_id
+
+    n = len(tweets)
+    ids = np.array([tweet["id"] for tweet in tweets], np.int64)
+    conversation_ids = np.array(
+        [tweet["conversation_id"] for tweet in tweets], np.int64
+    )
+
+    # public and non public metrics share one column per metric name
+    metric_sets = (
+        [tweet["public_metrics"] or {} for tweet in tweets],
+        [tweet["non_public_metrics"] or {} for tweet in tweets],
+    )
+    read_sets = []
+    for metric_set in metric_sets:
+        values = None
+        if len(set(map(len, metric_set))) == 1 and metric_set[0]:
+            # usually every tweet has the same metrics, read them in one pass
+            names = list(metric_set[0])
+            try:
+                values = np.array(
+                    list(map(itemgetter(*names), metric_set)), np.int64
+                ).reshape(n, len(names))
+                seen = np.ones(values.shape, bool)
+            except KeyError:
+                pass
+        if values is None:
+            names = list(dict.fromkeys(chain.from_iterable(metric_set)))
+            # -1 marks a metric a tweet does not have
+            values = np.array(
+                [[metrics.get(name, -1) for name in names] for metrics in metric_set],
+                np.int64,
+            ).reshape(n, len(names))
+            seen = values >= 0
+            values = values.clip(min=0)
+        read_sets.append((names, values, seen))
+    metric_names = list(dict.fromkeys(chain(*(names for names, _, _ in read_sets))))
+    matrices = []
+    for names, values, seen in read_sets:
+        columns = [metric_names.index(name) for name in names]
+        matrix = np.zeros((n, len(metric_names)), np.int64)
+        matrix_seen = np.zeros((n, len(metric_names)), bool)
+        matrix[:, columns] = values
+        matrix_seen[:, columns] = seen
+        matrices.append((matrix, matrix_seen))
+    (public, public_seen), (non_public, non_public_seen) = matrices
+
+    # sort by conversation and newest tweet first inside every conversation
+    order = np.lexsort((-ids, conversation_ids))
+    sorted_conversations = conversation_ids[order]
+    starts = np.flatnonzero(
+        np.r_[True, sorted_conversations[1:] != sorted_conversations[:-1]]
+    )
+    sizes = np.diff(np.r_[starts, n])
+    newest_ids = ids[order][starts]
+    oldest_ids = ids[order][starts + sizes - 1]
+    group_conversation_ids = sorted_conversations[starts].tolist()
+
+    public_sums = np.add.reduceat(public[order], starts, axis=0)
+    non_public_sums = np.add.reduceat(non_public[order], starts, axis=0)
+    non_public_present = np.logical_or.reduceat(non_public_seen[order], starts, axis=0)
+    present = (
+        np.logical_or.reduceat(public_seen[order], starts, axis=0) | non_public_present
+    )
+    # threads sum both metric sets, single tweets let non public metrics win
+    metrics = np.where(
+        (sizes > 1)[:, None],
+        public_sums + non_public_sums,
+        np.where(non_public_present, non_public_sums, public_sums),
+    )
+    metrics = metrics.tolist()
+    present = present.tolist()
+    all_present = all(map(all, present))
+    order = order.tolist()
+    starts = starts.tolist()
+    sizes = sizes.tolist()
+    oldest_ids = oldest_ids.tolist()
+
+    new_latest_post_id = latest_post_id
+    tweets_clean = []
+    for group in np.argsort(-newest_ids, kind="stable").tolist():
+        start, size = starts[group], sizes[group]
+        rows = order[start : start + size]
+        newest = tweets[rows[0]]
+        if size > 1:
+            text = "\n\n".join(tweets[row]["text"] for row in reversed(rows))
+        else:
+            # exlude tweet where the author is replying to themselves
+            if (
+                newest["referenced_tweets"]
+                and newest["referenced_tweets"][0]["type"] == "replied_to"
+                and newest["in_reply_to_user_id"] == newest["author_id"]
+            ):
+                continue
+            note_tweet = newest["data"].get("note_tweet", None)
+            text = note_tweet["text"] if note_tweet else newest["text"]
+
+        post_tweet_id = oldest_ids[group]
+        if new_latest_post_id is None or post_tweet_id > new_latest_post_id:
+            new_latest_post_id = post_tweet_id
+        metadata = {
+            "text": text,
+            "created_at": newest["created_at"],
+            "is_thread": size > 1,
+        }
+        if all_present:
+            metadata.update(zip(metric_names, metrics[group]))
+        else:
+            metadata.update(
+                (name, value)
+                for name, value, seen in zip(
+                    metric_names, metrics[group], present[group]
+                )
+                if seen
+            )
+        metadata["author_id"] = newest["author_id"]
+        tweets_clean.append(
+            {
+                "id": str(newest["id"]),
+                "text": text,
+                "conversation_id": group_conversation_ids[group],
+                "metadata": metadata,
+            }
+        )
+    logger.info(f"Processed {len(tweets_clean)} posts from {n} tweets")
+
+    return tweets_clean, new_latest_post_id
+
+
+@app.cls(volumes={CACHE_MOUNT_PATH: cache_volume})
 class XClient:
     @modal.enter()
     def connect(self):
-        self.client = tweepy.Client(
+        self.rate_limits = RateLimitScheduler(rate_limits)
+        self.client = RateLimitedClient(
+            self.rate_limits,
             bearer_token=os.getenv("X_BEARER_TOKEN"),
             access_token=os.getenv("X_ACCESS_TOKEN"),
             access_token_secret=os.getenv("X_ACCESS_TOKEN_SECRET"),
             consumer_key=os.getenv("X_ACCESS_CONSUMER_KEY"),
             consumer_secret=os.getenv("X_ACCESS_CONSUMER_SECRET"),
-            wait_on_rate_limit=True,
+            wait_on_rate_limit=False,
         )
+        self.cache = TweetCache(
+            str(CACHE_MOUNT_PATH / "tweets.sqlite"), TWEET_METRICS_TTL, USER_TTL, cache_counters
+        )
+        self.read_checkpoint = modal.Function.lookup("datastore", "read_checkpoint")
+        self.save_checkpoint = modal.Function.lookup("datastore", "save_checkpoint")
+        self.clear_checkpoint = modal.Function.lookup("datastore", "clear_checkpoint")
         return self.client
 
+    @modal.exit()
+    def disconnect(self):
+        logger.info(f"Tweet cache counters: {dict(self.cache.counters)}")
+        self.cache.close()
+        cache_volume.commit()
+
+    def lookup_tweets(
+        self, tweet_ids: List[int]
+    ) -> Dict[int, "tweepy.Tweet"]:
+        """
+        Look up tweets in the cache first and fetch only the missing ones from X.
+
+        Tweets with stale public_metrics are refreshed with a request for just
+        that field, the immutable fields are never requested again.
+
+        Returns:
+            Dict[int, tweepy.Tweet]: The tweets by id, ids X could not return are left out.
+        """
+        client = self.client
+        tweet_ids = list(dict.fromkeys(int(tweet_id) for tweet_id in tweet_ids))
+        payloads, stale_ids = self.cache.get_tweets(tweet_ids)
+        missing_ids = [tweet_id for tweet_id in tweet_ids if tweet_id not in payloads]
+
+        for i in range(0, len(missing_ids), GET_TWEETS_MAX_IDS):
+            response = client.get_tweets(
+                ids=missing_ids[i : i + GET_TWEETS_MAX_IDS],
+                tweet_fields=TWEET_FIELDS,
+                expansions=TWEET_EXPANSIONS,
+            )
+            fetched = [tweet.data for tweet in response.data or []]
+            self.cache.put_tweets(fetched)
+            payloads.update({int(payload["id"]): payload for payload in fetched})
+
+        for i in range(0, len(stale_ids), GET_TWEETS_MAX_IDS):
+            response = client.get_tweets(
+                ids=stale_ids[i : i + GET_TWEETS_MAX_IDS],
+                tweet_fields=["public_metrics"],
+            )
+            refreshed = []
+            for tweet in response.data or []:
+                payloads[tweet.id]["public_metrics"] = tweet.data["public_metrics"]
+                refreshed.append(payloads[tweet.id])
+            self.cache.put_tweets(refreshed)
+
+        return {
+            tweet_id: tweepy.Tweet(payload) for tweet_id, payload in payloads.items()
+        }
+
+    def lookup_user(self, username: str = None, user_id: int = None) -> Dict:
+        payload = self.cache.get_user(username=username, user_id=user_id)
+        if payload is None:
+            if username:
+                user = self.client.get_user(username=username, user_fields=USER_FIELDS)
+            else:
+                user = self.client.get_user(id=user_id, user_fields=USER_FIELDS)
+            payload = user.data.data
+            self.cache.put_user(payload)
+        return payload
+
     @modal.method()
     def get_user_id(self, username: str) -> int:
-        client = self.client
         try:
-            return client.get_user(username=username).data.id
+            return int(self.lookup_user(username=username)["id"])
         except tweepy.TweepyException as e:
-            return {"error": f"RequestException: {e}"}
+            return error_response(e)
 
     @modal.method()
     def get_user_info(self, username=None, user_id=None):
-        client = self.client
         try:
-            if username:
-                return client.get_user(
-                    username=username, user_fields=["description"]
-                ).data
-            elif user_id:
-                return client.get_user(id=user_id, user_fields=["description"]).data
+            if username or user_id:
+                return tweepy.User(
+                    self.lookup_user(username=username, user_id=user_id)
+                )
         except tweepy.TweepyException as e:
-            return {"error": f"RequestException: {e}"}
+            return error_response(e)
 
     @modal.method()
-    def get_user_posts(self, user_id: int, max_post_id: int, end_time=None):
+    def plan_requests(self, requests: Dict[str, int]) -> Dict[str, float]:
+        """Return retry after hints for planned requests, see RateLimitScheduler.plan."""
+        return self.rate_limits.plan(requests)
+
+    @modal.method()
+    def rate_limit_status(self) -> Dict:
+        """Return the shared rate limit buckets and the seconds spent throttled."""
+        return self.rate_limits.status()
+
+    @modal.method()
+    def cache_stats(self) -> Dict[str, int]:
+        """Return the tweet cache hit and miss counters summed over all containers."""
+        return self.cache.stats()
+
+    @modal.method()
+    def iter_user_posts(
+        self,
+        user_id: int,
+        max_post_id: int,
+        end_time=None,
+        pagination_token=None,
+        start_time=None,
+    ) -> Iterator[Tuple[List["tweepy.Tweet"], str]]:
+        """
+        Yield the posts of a user page by page as they arrive from X.
+
+        Every page is yielded together with the token of the next page, so a crawl
+        can be resumed from there. Raises tweepy.TweepyException, callers decide
+        how to handle a failed page.
+        """
         logger.info(f"Max post ID: {max_post_id}")
         client = self.client
-        all_posts = []
+        while True:
+            user_tweets = client.get_users_tweets(
+                user_auth=True,
+                id=user_id,
+                start_time=start_time,
+                end_time=end_time,
+                max_results=os.getenv("MAX_RESULTS"),
+                since_id=max_post_id,# TODO: Add here the author_id to the tweet_fields
+                user_fields=["id"],
+                tweet_fields=[
+                    "created_at",
+                    "public_metrics",
+                    "conversation_id",
+                    "non_public_metrics",
+                    "note_tweet",
+                ],
+                pagination_token=pagination_token,
+                expansions=["referenced_tweets.id", "in_reply_to_user_id"],
+            )
+
+            # add author_id because it is not included in this call but need for pinecone
+            for tweet in user_tweets.data or []:
+                tweet.author_id = user_id
+
+            pagination_token = user_tweets.meta.get("next_token", None)
+            yield user_tweets.data or [], pagination_token
+            if not pagination_token:
+                break
+
+    def user_post_pages(self, user_id: int, max_post_id: int, end_time=None):
+        """
+        Yield the pages of iter_user_posts, the saved pages of an interrupted crawl first.
+
+        Every page with a next page is checkpointed before it is yielded and the
+        checkpoint is cleared once the crawl is complete, so a crawl that failed
+        halfway with the same since_id resumes where it stopped.
+        """
+        checkpoint_key = f"user_posts_{user_id}_{max_post_id}"
+        pages = self.read_checkpoint.remote(checkpoint_key) or []
         pagination_token = None
-        try:
-            while True:
-                user_tweets = client.get_users_tweets(
-                    user_auth=True,
-                    id=user_id,
-                    end_time=end_time,
-                    max_results=os.getenv("MAX_RESULTS"),
-                    since_id=max_post_id,# TODO: Add here the author_id to the tweet_fields
-                    user_fields=["id"],
-                    tweet_fields=[
-                        "created_at",
-                        "public_metrics",
-                        "conversation_id",
-                        "non_public_metrics",
-                        "note_tweet",
-                    ],
-                    pagination_token=pagination_token,
-                    expansions=["referenced_tweets.id", "in_reply_to_user_id"],
+        if pages:
+            logger.info(f"Resuming {checkpoint_key} after page {len(pages)}")
+            # the pagination token is only valid for the same query
+            if pages[0]["end_time"] is not None:
+                end_time = datetime.datetime.fromisoformat(pages[0]["end_time"])
+            for saved_page in pages:
+                posts = [tweepy.Tweet(data) for data in saved_page["tweets"]]
+                for tweet in posts:
+                    tweet.author_id = user_id
+                yield posts
+            pagination_token = pages[-1]["pagination_token"]
+        page_index = len(pages)
+        for page, pagination_token in self.iter_user_posts.local(
+            user_id, max_post_id, end_time, pagination_token
+        ):
+            if pagination_token:
+                page_index += 1
+                self.save_checkpoint.remote(
+                    checkpoint_key,
+                    page_index,
+                    {
+                        "pagination_token": pagination_token,
+                        "tweets": [tweet.data for tweet in page],
+                        "end_time": end_time.isoformat() if end_time else None,
+                    },
                 )
-                
-                if user_tweets.data:
-                    # add author_id because it is not included in this call but need for pinecone
-                    for tweet in user_tweets.data:
-                        tweet.author_id = user_id
-                    all_posts.extend(user_tweets.data)
-
-                pagination_token = user_tweets.meta.get("next_token", None)
-                if not pagination_token:
-                    break
-            return all_posts
+            yield page
+        if page_index:
+            self.clear_checkpoint.remote(checkpoint_key)
+
+    @modal.method()
+    def get_user_posts(self, user_id: int, max_post_id: int, end_time=None):
+        try:
+            return [
+                post
+                for page in self.user_post_pages(user_id, max_post_id, end_time)
+                for post in page
+            ]
         except tweepy.TweepyException as e:
-            return {"error": f"RequestException: {e}"}
+            return error_response(e)
 
     @modal.method()
     def fetch_full_thread(self, tweet_id: int):
-        client = self.client
-        thread = []
-
-        current_tweet = client.get_tweet(
-            tweet_id,
-            tweet_fields=[
-                "created_at",
-                "public_metrics",
-                "conversation_id",
-                "in_reply_to_user_id",
-            ],
-            expansions=["referenced_tweets.id", "author_id"],
-        ).data
-
-        while current_tweet:
-            # Convert the tweet object to a dictionary
-            tweet_dict = {
-                "id": current_tweet.id,
-                "text": current_tweet.text,
-                "created_at": current_tweet.created_at.isoformat()
-                if current_tweet.created_at
-                else None,
-                "public_metrics": dict(current_tweet.public_metrics)
-                if current_tweet.public_metrics
-                else None,
-                "conversation_id": current_tweet.conversation_id,
-                "in_reply_to_user_id": current_tweet.in_reply_to_user_id,
-                "referenced_tweets": [
-                    dict(ref) for ref in current_tweet.referenced_tweets
-                ]
-                if current_tweet.referenced_tweets
-                else None,
-                "author_id": current_tweet.author_id,
-            }
-            thread.append(tweet_dict)
-
-            if current_tweet.referenced_tweets:
-                current_tweet = client.get_tweet(
-                    current_tweet.referenced_tweets[0].id,
-                    tweet_fields=[
-                        "created_at",
-                        "public_metrics",
-                        "conversation_id",
-                        "in_reply_to_user_id",
-                    ],
-                    expansions=["referenced_tweets.id", "author_id"],
-                ).data
-            else:
-                current_tweet = None
-
-        thread.reverse()
-        return thread
+        return self.fetch_threads.local([tweet_id])[tweet_id]
 
     @modal.method()
-    def get_original_posts(self, replies):
-        client = self.client
-        original_post_ids = [reply["referenced_tweets"][0]["id"] for reply in replies]
-        original_posts = []
-        missing_tweet_ids_list = []
+    def fetch_threads(self, tweet_ids: List[int]) -> Dict[int, List[Dict]]:
+        """
+        Reconstruct the reply chains of many tweets at once.
+
+        All chains are walked up together, one level per round. Every level is
+        resolved with batched `get_tweets` calls of up to 100 ids, so the number
+        of API calls grows with the thread depth and not with the number of tweets.
 
-        def fetch_tweets_in_chunks(ids_chunk):
+        Parameters:
+            tweet_ids (List[int]): The ids of the tweets whose threads are resolved.
+
+        Returns:
+            Dict[int, List[Dict]]: The thread of every tweet id, oldest tweet first.
+        """
+        threads = {tweet_id: [] for tweet_id in tweet_ids}
+        # maps the tweet a thread started from to the next ancestor to resolve
+        pending = {tweet_id: tweet_id for tweet_id in tweet_ids}
+        fetched = {}
+        missing = set()
+
+        while pending:
+            level_ids = list(
+                {
+                    ancestor_id
+                    for ancestor_id in pending.values()
+                    if ancestor_id not in fetched and ancestor_id not in missing
+                }
+            )
             try:
-                response = client.get_tweets(
-                    ids=ids_chunk,
-                    expansions=["referenced_tweets.id", "author_id"],
-                    tweet_fields=[
-                        "created_at",
-                        "public_metrics",
-                        "conversation_id",
-                        "note_tweet",
-                    ],
-                )
-                missing_tweet_ids = [
-                    int(error["value"])
-                    for error in response.errors
-                    if "Could not find tweet with ids" in error["detail"]
-                ]
-                return response.data, missing_tweet_ids
+                tweets = self.lookup_tweets(level_ids)
             except tweepy.TweepyException as e:
-                return {"error": f"RequestException: {e}"}, []
+                logger.error(f"Error fetching thread level {level_ids}: {e}")
+                break
+            fetched.update(tweets)
+            missing.update(set(level_ids) - tweets.keys())
 
-        chunk_size = 100
-        for i in range(0, len(original_post_ids), chunk_size):
-            ids_chunk = original_post_ids[i : i + chunk_size]
-            tweets, missing_tweet_ids = fetch_tweets_in_chunks(ids_chunk)
-            missing_tweet_ids_list.extend(missing_tweet_ids)
-
-            for tweet in tweets:
+            next_pending = {}
+            for root_id, ancestor_id in pending.items():
+                current_tweet = fetched.get(ancestor_id)
+                if current_tweet is None:
+                    continue
+                threads[root_id].append(tweet_to_dict(current_tweet))
                 if (
-                    "in_reply_to_status_id" in tweet
-                    and tweet["in_reply_to_status_id"] is not None
+                    current_tweet.referenced_tweets
+                    and current_tweet.referenced_tweets[0].type == "replied_to"
                 ):
-                    thread = self.fetch_full_thread(tweet.id)
-                    original_posts.append(thread)
-                else:
-                    original_posts.append(tweet)
+                    next_pending[root_id] = current_tweet.referenced_tweets[0].id
+            pending = next_pending
+
+        for thread in threads.values():
+            thread.reverse()
+        return threads
+
+    @modal.method()
+    def get_original_posts(self, replies):
+        original_post_ids = [
+            int(reply["referenced_tweets"][0]["id"]) for reply in replies
+        ]
+        original_posts = []
+        try:
+            tweets = self.lookup_tweets(original_post_ids)
+        except tweepy.TweepyException as e:
+            return error_response(e), []
+        missing_tweet_ids_list = [
+            tweet_id for tweet_id in original_post_ids if tweet_id not in tweets
+        ]
+
+        # positions in original_posts whose thread is resolved in one batch below
+        thread_positions = {}
+        for tweet_id in original_post_ids:
+            tweet = tweets.get(tweet_id)
+            if tweet is None:
+                continue
+            # an original post that answers another tweet is replaced by its whole thread
+            if (
+                tweet.referenced_tweets
+                and tweet.referenced_tweets[0].type == "replied_to"
+            ):
+                thread_positions[len(original_posts)] = tweet.id
+                original_posts.append(None)
+            else:
+                original_posts.append(tweet)
+
+        if thread_positions:
+            threads = self.fetch_threads.local(list(set(thread_positions.values())))
+            for position, tweet_id in thread_positions.items():
+                original_posts[position] = threads[tweet_id]
 
         return original_posts, missing_tweet_ids_list
 
     @modal.method()
-    def get_list_tweets(self, list_id: str, latest_post_id: int):
+    def iter_list_tweets(
+        self, list_id: str, latest_post_id: int, pagination_token=None
+    ) -> Iterator[Tuple[List["tweepy.Tweet"], Dict, str]]:
+        """
+        Yield the new tweets of a list page by page as they arrive from X.
+
+        Every page is yielded as the tweets newer than latest_post_id without
+        media, together with the authors seen on that page and the token of the
+        next page, which is None on the last page. Raises
+        tweepy.TweepyException, callers decide how to handle a failed page.
+        """
         client = self.client
         if not isinstance(client, tweepy.Client):
             raise ValueError(
@@ -203,186 +869,175 @@ class XClient:
             )
         if not isinstance(list_id, str) or not list_id.strip():
             raise ValueError("Provided list_id is not a valid non-empty string")
-        all_tweets = []
-        pagination_token = None
-        users = {}
-        try:
-            while True:
-                list_tweets = client.get_list_tweets(
-                    id=list_id,
-                    max_results=os.getenv("MAX_RESULTS"),
-                    expansions=[
-                        "attachments.media_keys",
-                        "referenced_tweets.id",
-                        "author_id",
-                    ],
-                    tweet_fields=[
-                        "created_at",
-                        "public_metrics",
-                        "conversation_id",
-                        "author_id",
-                        "in_reply_to_user_id",
-                        "attachments",
-                        "note_tweet",
-                    ],
-                    media_fields=["url", "type"],
-                    user_fields=["username", "description", "id"],
-                    pagination_token=pagination_token,
-                    user_auth=True,
-                )
-                # Extract tweets and user information from the response
-                list_tweet_data = list_tweets.data
-                if list_tweet_data is None:
-                    return None, None
-
-                # Convert users to dictionaries
-                for user in list_tweets.includes["users"]:
-                    user_id = user["id"]
-                    users[user_id] = {
-                        "id": user_id,
-                        "username": user["name"],
-                        "description": user.get("description", ""),
-                    }
-                # media = {media["media_key"]: media for media in list_tweets.includes["media"]}
-                # to get images I need to use this: list_tweets.includes and match this then to the media id.
-                # all this new feature I also need then to add to the tweet/reply processing. (tweets to database)
-                # Filter out all post with media:
-                list_tweet_data = [
-                    tweet for tweet in list_tweet_data if not tweet.attachments
-                ]
-                if list_tweet_data:
-                    # Filter tweets before adding to all_tweets
-                    new_tweets = [tweet for tweet in list_tweet_data if tweet.id > latest_post_id]
-                    all_tweets.extend(new_tweets)
-                    
-                    # Check if we've reached or passed the latest_post_id
-                    if any(tweet.id <= latest_post_id for tweet in list_tweet_data):
-                        break
-                else:
-                    # No more tweets to process
-                    break
-
-                pagination_token = list_tweets.meta.get("next_token", None)
-                if not pagination_token:
-                    break
-
-            # can I move this part to the process tweets function? Is it already implemnted?
-            all_tweets_clean = []
-            for tweet in all_tweets:
-                if tweet.referenced_tweets is None or (
-                    tweet.referenced_tweets[0].type == "replied_to"
-                    and tweet.in_reply_to_user_id == tweet.author_id
-                ):
-                    all_tweets_clean.append(tweet)
-            # need refinement
-            all_tweets_clean = self.process_tweets.local(
-                all_tweets_clean, latest_post_id
-            )[0]
-            return all_tweets_clean, users
-        except tweepy.TweepyException as e:
-            logging.error(
-                f"Error fetching list tweets for list {list_id} with pagination token {pagination_token} and latest_post_id {latest_post_id}: {e}"
+        while True:
+            list_tweets = client.get_list_tweets(
+                id=list_id,
+                max_results=os.getenv("MAX_RESULTS"),
+                expansions=[
+                    "attachments.media_keys",
+                    "referenced_tweets.id",
+                    "author_id",
+                ],
+                tweet_fields=[
+                    "created_at",
+                    "public_metrics",
+                    "conversation_id",
+                    "author_id",
+                    "in_reply_to_user_id",
+                    "attachments",
+                    "note_tweet",
+                ],
+                media_fields=["url", "type"],
+                user_fields=["username", "description", "id"],
+                pagination_token=pagination_token,
+                user_auth=True,
             )
-            return []
+            # Extract tweets and user information from the response
+            list_tweet_data = list_tweets.data
+            if list_tweet_data is None:
+                return
 
-    @modal.method()
-    def process_tweets(
-        self, tweets, latest_post_id: int = None
-    ) -> Tuple[List[Dict], int]:
-        # Group tweets by conversation_id
-        threads = defaultdict(list)
-        new_latest_post_id = latest_post_id
+            # Convert users to dictionaries
+            users = {}
+            for user in list_tweets.includes["users"]:
+                user_id = user["id"]
+                users[user_id] = {
+                    "id": user_id,
+                    "username": user["name"],
+                    "description": user.get("description", ""),
+                }
+            # media = {media["media_key"]: media for media in list_tweets.includes["media"]}
+            # to get images I need to use this: list_tweets.includes and match this then to the media id.
+            # all this new feature I also need then to add to the tweet/reply processing. (tweets to database)
+            # Filter out all post with media:
+            list_tweet_data = [
+                tweet for tweet in list_tweet_data if not tweet.attachments
+            ]
+            if not list_tweet_data:
+                # No more tweets to process
+                yield [], users, None
+                return
 
-        for tweet in tweets:
-            threads[tweet["conversation_id"]].append(tweet)
+            # Filter tweets before yielding the page
+            new_tweets = [tweet for tweet in list_tweet_data if tweet.id > latest_post_id]
+            # Check if we've reached or passed the latest_post_id
+            if any(tweet.id <= latest_post_id for tweet in list_tweet_data):
+                yield new_tweets, users, None
+                return
 
-        processed_tweets = []
+            pagination_token = list_tweets.meta.get("next_token", None)
+            yield new_tweets, users, pagination_token
+            if not pagination_token:
+                return
 
-        for conversation_id, thread_tweets in threads.items():
-            sorted_tweets = sorted(
-                thread_tweets, key=lambda x: x["id"], reverse=True
+    @staticmethod
+    def filter_own_posts(tweets):
+        """Keep original posts and the follow up tweets of an author's own threads."""
+        return [
+            tweet
+            for tweet in tweets
+            if tweet.referenced_tweets is None
+            or (
+                tweet.referenced_tweets[0].type == "replied_to"
+                and tweet.in_reply_to_user_id == tweet.author_id
             )
+        ]
 
-            # threads with more than one tweet
-            if len(sorted_tweets) > 1:
-                combined_text = "\n\n".join(
-                    tweet["text"] for tweet in reversed(sorted_tweets)
-                )
-                combined_metrics = defaultdict(int)
+    def list_tweet_pages(self, list_id: str, latest_post_id: int):
+        """
+        Yield the pages and authors of iter_list_tweets, the saved pages of an interrupted crawl first.
 
-                for tweet in sorted_tweets:
-                    for metric, value in tweet["public_metrics"].items():
-                        combined_metrics[metric] += value
-                    if tweet["non_public_metrics"]:
-                        for metric, value in tweet["non_public_metrics"].items():
-                            combined_metrics[metric] += value
-
-                processed_tweet = {
-                    "conversation_id": conversation_id,
-                    "text": combined_text,
-                    "created_at": sorted_tweets[0]["created_at"],
-                    "metrics": dict(combined_metrics),
-                    "tweet_ids": [str(tweet["id"]) for tweet in sorted_tweets],
-                    "is_thread": True,
-                    "author_id": sorted_tweets[0]["author_id"],
-                }
-                logger.info(f"Processed thread: {str(sorted_tweets[0]['id'])}")
-            # tweets and longform tweets
-            else:
-                tweet = sorted_tweets[0]
-                # exlude tweet where the author is replying to themselves
-                if (
-                    tweet["referenced_tweets"]
-                    and tweet["referenced_tweets"][0]["type"] == "replied_to"
-                    and tweet["in_reply_to_user_id"] == tweet["author_id"]
-                ):
-                    logger.info(f"Excluded tweet: {str(tweet['id'])}")
-                    continue
-                all_metrics = {**tweet["public_metrics"]}
-                if tweet["non_public_metrics"]:
-                    all_metrics.update(tweet["non_public_metrics"])
-
-                note_tweet = tweet["data"].get("note_tweet", None)
-                if note_tweet:
-                    text = tweet["data"]["note_tweet"]["text"]
-                    logger.info(f"Note tweet: {str(tweet['id'])}")
-                else:
-                    text = tweet["text"]
-                    logger.info(f"Processed tweet: {str(tweet['id'])}")
-                processed_tweet = {
-                    "conversation_id": conversation_id,
-                    "text": text,
-                    "created_at": tweet["created_at"],
-                    "metrics": all_metrics,
-                    "tweet_ids": [str(tweet["id"])],
-                    "is_thread": False,
-                    "author_id": tweet["author_id"],
+        Checkpoints work like in user_post_pages, keyed by the list and latest_post_id.
+        """
+        checkpoint_key = f"list_tweets_{list_id}_{latest_post_id}"
+        pages = self.read_checkpoint.remote(checkpoint_key) or []
+        pagination_token = None
+        if pages:
+            logger.info(f"Resuming {checkpoint_key} after page {len(pages)}")
+            for saved_page in pages:
+                # json turns the user ids into strings
+                yield [tweepy.Tweet(data) for data in saved_page["tweets"]], {
+                    int(user_id): user for user_id, user in saved_page["users"].items()
                 }
+            pagination_token = pages[-1]["pagination_token"]
+        page_index = len(pages)
+        for page, page_users, pagination_token in self.iter_list_tweets.local(
+            list_id, latest_post_id, pagination_token
+        ):
+            if pagination_token:
+                page_index += 1
+                self.save_checkpoint.remote(
+                    checkpoint_key,
+                    page_index,
+                    {
+                        "pagination_token": pagination_token,
+                        "tweets": [tweet.data for tweet in page],
+                        "users": page_users,
+                    },
+                )
+            yield page, page_users
+        if page_index:
+            self.clear_checkpoint.remote(checkpoint_key)
 
-            processed_tweets.append(processed_tweet)
-        processed_tweets.sort(key=lambda x: int(x["tweet_ids"][0]), reverse=True)
+    def pack_list_tweets(self, tweets, latest_post_id: int) -> List[Tuple]:
+        # can I move this part to the process tweets function? Is it already implemnted?
+        tweets_clean = self.filter_own_posts(tweets)
+        # need refinement
+        tweets_clean = self.process_tweets.local(tweets_clean, latest_post_id)[0]
+        # only the packed records are sent back, see TweetRecord
+        return [TweetRecord.from_processed(tweet).pack() for tweet in tweets_clean]
 
-        tweets_clean = []
-        for tweet in processed_tweets:
-            post_tweet_id = int(tweet["tweet_ids"][-1])
-            if new_latest_post_id is None or post_tweet_id > new_latest_post_id:
-                new_latest_post_id = post_tweet_id
-            metadata = {
-                "text": tweet["text"],
-                "created_at": tweet["created_at"],
-                "is_thread": tweet["is_thread"],
-                **tweet["metrics"],
-                "author_id": tweet["author_id"],
-            }
-            tweets_clean.append(
-                {
-                    "id": tweet["tweet_ids"][0],
-                    "text": tweet["text"],
-                    "metadata": metadata,
-                }
+    @modal.method()
+    def get_list_tweets(self, list_id: str, latest_post_id: int):
+        all_tweets = []
+        users = {}
+        has_pages = False
+        try:
+            for page, page_users in self.list_tweet_pages(list_id, latest_post_id):
+                has_pages = True
+                all_tweets.extend(page)
+                users.update(page_users)
+            if not has_pages:
+                return None, None
+            return self.pack_list_tweets(all_tweets, latest_post_id), users
+        except tweepy.TweepyException as e:
+            error = error_response(e)
+            logging.error(
+                f"Error fetching list tweets for list {list_id} and latest_post_id {latest_post_id}: {error}"
+            )
+            return error
+
+    @modal.method()
+    def stream_list_tweets(
+        self, list_id: str, latest_post_id: int
+    ) -> Iterator[Tuple[List[Tuple], Dict]]:
+        """
+        Yield the packed TweetRecords of a list and their authors page by page, so
+        the job classifies and answers the first page while later pages are loading.
+
+        Unlike get_list_tweets every page is processed on its own, a thread that
+        spans two pages is therefore returned as two entries. A failed request
+        ends the stream with its error_response.
+        """
+        try:
+            for page, users in self.list_tweet_pages(list_id, latest_post_id):
+                records = self.pack_list_tweets(page, latest_post_id)
+                if records:
+                    yield records, users
+        except tweepy.TweepyException as e:
+            error = error_response(e)
+            logging.error(
+                f"Error streaming list tweets for list {list_id} and latest_post_id {latest_post_id}: {error}"
             )
+            yield error
 
-        return tweets_clean, new_latest_post_id
+    @modal.method()
+    def process_tweets(
+        self, tweets, latest_post_id: int = None
+    ) -> Tuple[List[Dict], int]:
+        if len(tweets) >= COLUMNAR_MIN_TWEETS:
+            return process_tweets_columnar(tweets, latest_post_id)
+        return process_tweets_rows(tweets, latest_post_id)
 
     @modal.method()
     def process_replies_for_upload(
@@ -395,12 +1050,18 @@ class XClient:
 
         data = []
         for reply, original_post in zip(replies, replies_original_post):
+            if isinstance(original_post, list):
+                # a thread from fetch_threads, oldest tweet first, the reply answers its last tweet
+                original_post = {
+                    **original_post[-1],
+                    "text": "\n\n".join(tweet["text"] for tweet in original_post),
+                }
             metadata = {}
             metadata["original_post"] = original_post["text"]
             metadata["original_post_id"] = original_post["id"]
             metadata["original_post_author_id"] = original_post["author_id"]
             metadata["original_post_created_at"] = original_post["created_at"]
-            original_post_metrics = original_post["public_metrics"]
+            original_post_metrics = original_post["public_metrics"] or {}
             metadata.update(
                 {f"original_post_{k}": v for k, v in original_post_metrics.items()}
             )
@@ -423,17 +1084,8 @@ class XClient:
                 latest_post_id = reply["id"]
         return data, latest_post_id
 
-    @modal.method()
-    def get_all_post_replies_from_user(
-        self, latest_post_id: int, username: str
-    ) -> Dict:
-        user_id = self.get_user_id.local(username=username)
-        print(f"User ID: {user_id}")
-
-        end_time = datetime.datetime.now() - datetime.timedelta(days=5)
-        posts = self.get_user_posts.local(user_id, latest_post_id, end_time)
-        print(f"Number of posts: {len(posts)}")
-
+    def posts_for_upload(self, posts, user_id: int, latest_post_id: int) -> Dict:
+        """Split posts into own tweets and replies with their original posts, ready for the upsert."""
         if posts == []:
             return {"tweets": [], "replies": [], "latest_post_id": []}
 
@@ -454,6 +1106,8 @@ class XClient:
         replies_original_post, missing_tweet_ids_list = self.get_original_posts.local(
             replies
         )
+        if isinstance(replies_original_post, dict):
+            return replies_original_post
 
         replies = [
             reply
@@ -473,6 +1127,134 @@ class XClient:
             "latest_post_id": new_latest_post_id,
         }
 
+    @modal.method()
+    def get_all_post_replies_from_user(
+        self, latest_post_id: int, username: str, backfill: bool = False
+    ) -> Dict:
+        user_id = self.get_user_id.local(username=username)
+        # error_response of a failed request, with the retry_after hint if rate limited
+        if isinstance(user_id, dict):
+            return user_id
+        print(f"User ID: {user_id}")
+
+        end_time = datetime.datetime.now() - datetime.timedelta(days=5)
+        if backfill:
+            posts = self.backfill_user_posts.local(user_id, latest_post_id, end_time)
+        else:
+            posts = self.get_user_posts.local(user_id, latest_post_id, end_time)
+        if isinstance(posts, dict):
+            return posts
+        print(f"Number of posts: {len(posts)}")
+        return self.posts_for_upload(posts, user_id, latest_post_id)
+
+    @modal.method()
+    def stream_post_replies_from_user(
+        self, latest_post_id: int, username: str, backfill: bool = False
+    ) -> Iterator[Dict]:
+        """
+        Yield the get_all_post_replies_from_user result page by page, so the job
+        embeds and upserts the first page while later pages are loading.
+
+        A backfill is fetched in parallel windows and yielded as one result. A
+        failed request ends the stream with its error_response.
+        """
+        if backfill:
+            yield self.get_all_post_replies_from_user.local(latest_post_id, username, backfill)
+            return
+        user_id = self.get_user_id.local(username=username)
+        if isinstance(user_id, dict):
+            yield user_id
+            return
+
+        end_time = datetime.datetime.now() - datetime.timedelta(days=5)
+        try:
+            for page in self.user_post_pages(user_id, latest_post_id, end_time):
+                if not page:
+                    continue
+                result = self.posts_for_upload(page, user_id, latest_post_id)
+                yield result
+                if "error" in result:
+                    return
+        except tweepy.TweepyException as e:
+            yield error_response(e)
+
+    @modal.method()
+    def get_user_posts_window(
+        self, user_id: int, latest_post_id: int, start_time, end_time
+    ) -> List["tweepy.Tweet"]:
+        """Fetch the posts of a user created between start_time and end_time."""
+        posts = []
+        for page, _ in self.iter_user_posts.local(
+            user_id, latest_post_id or None, end_time, start_time=start_time
+        ):
+            posts.extend(page)
+        logger.info(f"Fetched {len(posts)} posts between {start_time} and {end_time}")
+        return posts
+
+    @modal.method()
+    def backfill_user_posts(
+        self, user_id: int, latest_post_id: int, end_time, shards: int = BACKFILL_SHARDS
+    ):
+        """
+        Fetch the full post history of a user in parallel time windows.
+
+        X only returns the USER_TIMELINE_LIMIT most recent posts of a timeline,
+        so equal slices since the account creation would leave all but the last
+        window empty. One probe page measures how fast the user posts, the span
+        of the reachable history is estimated from it and split into equally
+        long windows that are fetched with `.starmap` in their own containers.
+        The oldest window still reaches back to the account creation, so no
+        post is missed when the estimate is off. The shards are merged and
+        de-duplicated by tweet id, newest first like get_user_posts.
+        """
+        try:
+            user = self.lookup_user(user_id=user_id)
+            probe = self.client.get_users_tweets(
+                user_auth=True,
+                id=user_id,
+                end_time=end_time,
+                since_id=latest_post_id or None,
+                max_results=BACKFILL_PROBE_SIZE,
+                tweet_fields=["created_at"],
+            )
+        except tweepy.TweepyException as e:
+            return error_response(e)
+        start_time = BACKFILL_START_TIME
+        if user.get("created_at"):
+            created_at = datetime.datetime.fromisoformat(
+                user["created_at"].replace("Z", "+00:00")
+            ).replace(tzinfo=None)
+            start_time = max(start_time, created_at)
+
+        probe_posts = probe.data or []
+        if not probe.meta.get("next_token") or len(probe_posts) < BACKFILL_PROBE_SIZE:
+            # the whole reachable history is about one page
+            shards = 1
+            oldest_time = start_time
+        else:
+            probe_oldest = probe_posts[-1].created_at.replace(tzinfo=None)
+            history = (end_time - probe_oldest) * (USER_TIMELINE_LIMIT / len(probe_posts))
+            oldest_time = max(start_time, end_time - history)
+        window = (end_time - oldest_time) / shards
+        windows = [
+            (
+                user_id,
+                latest_post_id,
+                start_time if shard == 0 else oldest_time + window * shard,
+                oldest_time + window * (shard + 1),
+            )
+            for shard in range(shards)
+        ]
+
+        posts = {}
+        try:
+            for shard_posts in XClient().get_user_posts_window.starmap(windows):
+                for post in shard_posts:
+                    posts[post.id] = post
+        except tweepy.TweepyException as e:
+            return error_response(e)
+        return sorted(posts.values(), key=lambda post: post.id, reverse=True)
+
     @app.local_entrypoint()
     def test():
         from modal import Function
@@ -495,8 +1277,10 @@ class XClient:
 
 
 @app.function()
-def accept_job(latest_post_id: int, username: str):
-    call = XClient().get_all_post_replies_from_user.spawn(latest_post_id, username)
+def accept_job(latest_post_id: int, username: str, backfill: bool = False):
+    call = XClient().get_all_post_replies_from_user.spawn(
+        latest_post_id, username, backfill
+    )
     return call.object_id
 
 